@@ -4,8 +4,15 @@ sys.path.append(os.path.dirname(os.path.dirname(__file__)))
 
 import time
 import streamlit as st
+from db.migrations import init
 from llm.sql_executor import answer_question
-from cache.cache_metrics import get_metrics, hit_rate
+from cache.warmup import start_warmup, warmup_status
+from cache.cache_metrics import (
+    aggregate_snapshot,
+    export_prometheus,
+    hit_rate,
+    latency_summary
+)
 
 st.set_page_config(
     page_title="Text-to-SQL GenAI Dashboard",
@@ -53,6 +60,17 @@ examples = [
     "List customers with highest spending"
 ]
 
+
+@st.cache_resource
+def warm_up_cache():
+    # Once per process: tables first, then warm-up in the background
+    # so the first render isn't blocked
+    init()
+    return start_warmup(examples)
+
+
+warm_up_cache()
+
 for ex in examples:
     if st.sidebar.button(ex):
         st.session_state.current_item = None
@@ -109,6 +127,12 @@ if item:
         st.success("Tier-1 Memory Cache Hit")
     elif item["source"] == "L2-cache":
         st.info("Tier-2 Persistent Cache Hit")
+    elif item["source"] == "semantic-cache":
+        st.info("Semantic Cache Hit (similar question)")
+    elif item["source"] == "coalesced":
+        st.info("Shared result from an identical in-flight request")
+    elif item["source"] == "plan-cache":
+        st.info("SQL Plan Cache Hit (cached SQL re-executed on fresh data)")
     else:
         st.warning("Generated by LLM (Cache Miss)")
 
@@ -126,11 +150,35 @@ if item:
     # Query Result
     st.subheader("Query Result")
 
+    df = item["df"]
+
+    if df.attrs.get("truncated"):
+        st.warning(f"Result truncated to the first {len(df)} rows")
+
+    # Only the visible page is rendered, however large the result is
+    page_col, size_col = st.columns([3, 1])
+
+    page_size = size_col.selectbox("Rows per page", [25, 50, 100, 500], index=1)
+    pages = max(1, -(-len(df) // page_size))
+
+    page = page_col.number_input(
+        f"Page (of {pages})",
+        min_value=1,
+        max_value=pages,
+        value=1,
+        step=1
+    )
+
+    start = (page - 1) * page_size
+    end = min(start + page_size, len(df))
+
     st.dataframe(
-        item["df"],
+        df.iloc[start:end],
         width="stretch"  
     )
 
+    st.caption(f"Showing rows {start + 1 if len(df) else 0}-{end} of {len(df)}")
+
     if item["usage"]:
 
         st.subheader("Token Usage")
@@ -141,6 +189,13 @@ if item:
         col2.metric("Completion Tokens", item["usage"]["completion_tokens"])
         col3.metric("Total Tokens", item["usage"]["total_tokens"])
         col4.metric("Cost (USD)", f"${item['usage']['cost_usd']:.6f}")
+
+        if item["usage"].get("schema_pruned"):
+            st.caption(
+                f"Schema pruned to {', '.join(item['usage']['schema_tables'])}: "
+                f"{item['usage']['schema_tokens_saved']} of "
+                f"{item['usage']['schema_tokens_full']} schema tokens saved"
+            )
         st.caption(f"Rows returned: {len(item['df'])}")
 
     if item["source"] != "LLM":
@@ -161,11 +216,59 @@ if item:
 st.divider()
 st.subheader(" Cache Metrics")
 
-metrics = get_metrics()
+# Summed across all worker processes when METRICS_DIR is set
+snapshot = aggregate_snapshot()
+metrics = {**snapshot["counters"], **snapshot["gauges"]}
 
-col1, col2, col3, col4 = st.columns(4)
+col1, col2, col3, col4, col5, col6 = st.columns(6)
 
 col1.metric("L1 Hits", metrics["l1_hits"])
 col2.metric("L2 Hits", metrics["l2_hits"])
-col3.metric("Misses", metrics["misses"])
-col4.metric("Hit Rate", f"{hit_rate() * 100:.2f}%")
\ No newline at end of file
+col3.metric("Plan Hits", metrics["plan_hits"])
+col4.metric("Semantic Hits", metrics["semantic_hits"])
+col5.metric("Misses", metrics["misses"])
+col6.metric("Hit Rate", f"{hit_rate(metrics) * 100:.2f}%")
+
+col1, col2, col3, _ = st.columns(4)
+
+col1.metric("L1 Entries", metrics["l1_entries"])
+col2.metric("L1 Size (MB)", f"{metrics['l1_bytes'] / (1024 * 1024):.2f}")
+col3.metric("L1 Evictions", metrics["l1_evictions"])
+
+warmup = warmup_status()
+if warmup["state"] != "idle":
+    st.caption(
+        f"Cache warm-up: {warmup['state']} - {warmup.get('loaded', 0)} questions preloaded "
+        f"({warmup.get('bytes', 0) / (1024 * 1024):.1f} MB)"
+    )
+
+col1, col2, col3, _ = st.columns(4)
+
+col1.metric("Prompt Tokens", metrics["prompt_tokens"])
+col2.metric("Completion Tokens", metrics["completion_tokens"])
+col3.metric("LLM Cost (USD)", f"${metrics['cost_usd']:.4f}")
+
+st.subheader(" Stage Latency")
+
+latencies = latency_summary(snapshot)
+
+if latencies:
+    st.dataframe(
+        [
+            {
+                "Stage": stage,
+                "Count": row["count"],
+                "p50 (ms)": round(row["p50_ms"], 2),
+                "p95 (ms)": round(row["p95_ms"], 2),
+                "p99 (ms)": round(row["p99_ms"], 2),
+                "Mean (ms)": round(row["mean_ms"], 2)
+            }
+            for stage, row in latencies.items()
+        ],
+        width="stretch"
+    )
+else:
+    st.caption("No requests recorded yet.")
+
+with st.expander("Prometheus metrics"):
+    st.code(export_prometheus(snapshot), language="text")
\ No newline at end of file
@@ -8,6 +8,7 @@ sys.path.append(os.path.dirname(__file__))
 
 from cache.cache_metrics import get_metrics, reset_metrics
 from cache.tier1_cache import clear_l1
+from db.migrations import init
 from llm.sql_executor import answer_question
 
 
@@ -24,6 +25,7 @@ def run_query(question: str, force_l2: bool = False):
         "source": source,
         "elapsed_ms": elapsed_ms,
         "rows": len(df),
+        "cols": len(df.columns),
         "usage": usage,
         "sql": sql,
     }
@@ -59,7 +61,7 @@ def summarize(main_runs, l2_runs):
         for i, r in enumerate(l2_runs, start=1):
             print(
                 f"L2 {i:02d}: source={r['source']:<8} latency={r['elapsed_ms']:.2f} ms "
-                f"rows={r['rows']}"
+                f"rows={r['rows']} cols={r['cols']}"
             )
 
     print("\n=== Summary ===")
@@ -117,6 +119,7 @@ def main():
     )
     args = parser.parse_args()
 
+    init()
     reset_metrics()
     clear_l1()
 
@@ -1,36 +1,373 @@
+import atexit
+import glob
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Per-process snapshots are written here so every worker's numbers
+# can be summed; unset keeps metrics process-local.
+METRICS_DIR = os.getenv("METRICS_DIR")
+METRICS_SNAPSHOT_INTERVAL = float(os.getenv("METRICS_SNAPSHOT_INTERVAL", 5))
+
+# Upper bounds in seconds; the last bucket is +Inf
+LATENCY_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0
+)
+
+STAGES = (
+    "l1_lookup",
+    "l2_lookup",
+    "schema_fetch",
+    "llm_generation",
+    "sql_execution",
+    "cache_write"
+)
+
+_lock = threading.Lock()
 
 _metrics = {
     "l1_hits": 0,
     "l2_hits": 0,
-    "misses": 0
+    "semantic_hits": 0,
+    "plan_hits": 0,
+    "coalesced": 0,
+    "misses": 0,
+    "l1_evictions": 0,
+    "prompt_tokens": 0,
+    "completion_tokens": 0,
+    "cost_usd": 0.0
 }
 
+# Point-in-time values, not reset with the counters
+_gauges = {
+    "l1_bytes": 0,
+    "l1_entries": 0
+}
+
+# stage -> {"buckets": [count per bucket, +Inf last], "sum": seconds, "count": n}
+_histograms = {}
+
+
+def _empty_histogram():
+    return {"buckets": [0] * (len(LATENCY_BUCKETS) + 1), "sum": 0.0, "count": 0}
+
+
+# pid of the process whose snapshot thread is running; a forked
+# worker doesn't inherit the thread, so it starts its own
+_snapshotter_pid = None
+_snapshotter_lock = threading.Lock()
+
+
+def _ensure_snapshotter():
+    """Start the snapshot thread on the first recorded metric, never at import."""
+    global _snapshotter_pid
+
+    if not METRICS_DIR or _snapshotter_pid == os.getpid():
+        return
+
+    with _snapshotter_lock:
+        if _snapshotter_pid == os.getpid():
+            return
+
+        if _snapshotter_pid is None:
+            atexit.register(write_snapshot)
+
+        _snapshotter_pid = os.getpid()
+        threading.Thread(target=_snapshot_loop, name="metrics-snapshot", daemon=True).start()
+
+
+def _inc(name: str, value=1):
+    _ensure_snapshotter()
+
+    with _lock:
+        _metrics[name] += value
+
 
 def record_l1_hit():
-    _metrics["l1_hits"] += 1
+    _inc("l1_hits")
 
 
 def record_l2_hit():
-    _metrics["l2_hits"] += 1
+    _inc("l2_hits")
+
+
+def record_semantic_hit():
+    _inc("semantic_hits")
+
+
+def record_plan_hit():
+    _inc("plan_hits")
+
+
+def record_coalesced():
+    _inc("coalesced")
 
 
 def record_miss():
-    _metrics["misses"] += 1
+    _inc("misses")
+
+
+def record_l1_eviction(count: int = 1):
+    _inc("l1_evictions", count)
+
+
+def record_usage(usage: dict):
+    """Token and cost counters from an LLM usage dict."""
+    _ensure_snapshotter()
+
+    with _lock:
+        _metrics["prompt_tokens"] += usage.get("prompt_tokens", 0)
+        _metrics["completion_tokens"] += usage.get("completion_tokens", 0)
+        _metrics["cost_usd"] += usage.get("cost_usd", 0.0)
+
+
+def set_l1_size(size_bytes: int, entries: int):
+    _ensure_snapshotter()
+
+    with _lock:
+        _gauges["l1_bytes"] = size_bytes
+        _gauges["l1_entries"] = entries
+
+
+def observe_latency(stage: str, seconds: float):
+    i = 0
+    while i < len(LATENCY_BUCKETS) and seconds > LATENCY_BUCKETS[i]:
+        i += 1
+
+    _ensure_snapshotter()
+
+    with _lock:
+        hist = _histograms.get(stage)
+        if hist is None:
+            hist = _histograms[stage] = _empty_histogram()
+
+        hist["buckets"][i] += 1
+        hist["sum"] += seconds
+        hist["count"] += 1
+
+
+@contextmanager
+def timed(stage: str):
+    """Record the duration of the block in the stage's histogram."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_latency(stage, time.perf_counter() - start)
+
+
+def _snapshot() -> dict:
+    with _lock:
+        return {
+            "counters": dict(_metrics),
+            "gauges": dict(_gauges),
+            "histograms": {
+                stage: {"buckets": list(h["buckets"]), "sum": h["sum"], "count": h["count"]}
+                for stage, h in _histograms.items()
+            }
+        }
 
 
 def get_metrics():
-    return _metrics.copy()
+    with _lock:
+        return {**_metrics, **_gauges}
 
 
 def reset_metrics():
-    for k in _metrics:
-        _metrics[k] = 0
+    with _lock:
+        for k in _metrics:
+            _metrics[k] = 0
+        _histograms.clear()
 
 
-def hit_rate():
-    total = sum(_metrics.values())
+def hit_rate(metrics: dict = None):
+    m = metrics or get_metrics()
+
+    hits = (
+        m["l1_hits"] + m["l2_hits"]
+        + m["semantic_hits"] + m["plan_hits"]
+        + m["coalesced"]
+    )
+    total = hits + m["misses"]
+
     if total == 0:
         return 0.0
 
-    hits = _metrics["l1_hits"] + _metrics["l2_hits"]
     return hits / total
+
+
+def percentile(hist: dict, q: float):
+    """
+    Estimate the q-quantile (0..1) in seconds from bucket counts,
+    interpolating linearly inside the bucket. None when empty.
+    """
+    if not hist["count"]:
+        return None
+
+    rank = q * hist["count"]
+    seen = 0
+
+    for i, count in enumerate(hist["buckets"]):
+        if seen + count >= rank and count:
+            lower = LATENCY_BUCKETS[i - 1] if i > 0 else 0.0
+
+            # Nothing better to report above the last finite bound
+            if i == len(LATENCY_BUCKETS):
+                return lower
+
+            return lower + (LATENCY_BUCKETS[i] - lower) * (rank - seen) / count
+
+        seen += count
+
+    return LATENCY_BUCKETS[-1]
+
+
+def latency_summary(snapshot: dict = None) -> dict:
+    """{stage: {count, mean_ms, p50_ms, p95_ms, p99_ms}}"""
+    histograms = (snapshot or _snapshot())["histograms"]
+    summary = {}
+
+    for stage in STAGES + tuple(s for s in histograms if s not in STAGES):
+        hist = histograms.get(stage)
+        if not hist or not hist["count"]:
+            continue
+
+        summary[stage] = {
+            "count": hist["count"],
+            "mean_ms": hist["sum"] / hist["count"] * 1000,
+            **{
+                f"p{int(q * 100)}_ms": percentile(hist, q) * 1000
+                for q in (0.5, 0.95, 0.99)
+            }
+        }
+
+    return summary
+
+
+# --- cross-process aggregation ---
+
+def _snapshot_path(pid: int = None) -> str:
+    return os.path.join(METRICS_DIR, f"metrics-{pid or os.getpid()}.json")
+
+
+def write_snapshot():
+    if not METRICS_DIR:
+        return
+
+    os.makedirs(METRICS_DIR, exist_ok=True)
+
+    path = _snapshot_path()
+    tmp = f"{path}.tmp"
+
+    with open(tmp, "w") as f:
+        json.dump(_snapshot(), f)
+
+    # Readers never see a half-written file
+    os.replace(tmp, path)
+
+
+def _snapshot_loop():
+    while True:
+        time.sleep(METRICS_SNAPSHOT_INTERVAL)
+        try:
+            write_snapshot()
+        except OSError as e:
+            print(f"Metrics snapshot failed: {e}")
+
+
+def _merge(total: dict, snap: dict, live: bool):
+    for k, v in snap["counters"].items():
+        total["counters"][k] = total["counters"].get(k, 0) + v
+
+    # Gauges of processes that stopped reporting are no longer current
+    if live:
+        for k, v in snap["gauges"].items():
+            total["gauges"][k] = total["gauges"].get(k, 0) + v
+
+    for stage, hist in snap["histograms"].items():
+        agg = total["histograms"].setdefault(stage, _empty_histogram())
+        agg["buckets"] = [a + b for a, b in zip(agg["buckets"], hist["buckets"])]
+        agg["sum"] += hist["sum"]
+        agg["count"] += hist["count"]
+
+
+def aggregate_snapshot() -> dict:
+    """
+    This process's live numbers plus the last snapshot of every other
+    process in METRICS_DIR. Counters and histograms of exited processes
+    still count; their gauges don't.
+    """
+    total = {"counters": {}, "gauges": {}, "histograms": {}}
+    _merge(total, _snapshot(), live=True)
+
+    if not METRICS_DIR:
+        return total
+
+    own = _snapshot_path()
+    stale_after = 3 * METRICS_SNAPSHOT_INTERVAL
+
+    for path in glob.glob(os.path.join(METRICS_DIR, "metrics-*.json")):
+        if path == own:
+            continue
+
+        try:
+            with open(path) as f:
+                snap = json.load(f)
+            live = time.time() - os.path.getmtime(path) < stale_after
+        except (OSError, ValueError):
+            continue
+
+        _merge(total, snap, live)
+
+    return total
+
+
+def aggregate_metrics() -> dict:
+    """Like get_metrics(), summed across processes."""
+    snap = aggregate_snapshot()
+    return {**snap["counters"], **snap["gauges"]}
+
+
+# --- Prometheus text exposition ---
+
+def _format_value(v) -> str:
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+def export_prometheus(snapshot: dict = None, prefix: str = "text2sql") -> str:
+    """Metrics in Prometheus text format (aggregated across processes by default)."""
+    snap = snapshot or aggregate_snapshot()
+    lines = []
+
+    for name, value in snap["counters"].items():
+        metric = f"{prefix}_{name}_total"
+        lines.append(f"# TYPE {metric} counter")
+        lines.append(f"{metric} {_format_value(value)}")
+
+    for name, value in snap["gauges"].items():
+        metric = f"{prefix}_{name}"
+        lines.append(f"# TYPE {metric} gauge")
+        lines.append(f"{metric} {_format_value(value)}")
+
+    metric = f"{prefix}_stage_latency_seconds"
+    lines.append(f"# HELP {metric} Latency of each pipeline stage.")
+    lines.append(f"# TYPE {metric} histogram")
+
+    for stage, hist in snap["histograms"].items():
+        cumulative = 0
+
+        for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), hist["buckets"]):
+            cumulative += count
+            lines.append(f'{metric}_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+
+        lines.append(f'{metric}_sum{{stage="{stage}"}} {_format_value(hist["sum"])}')
+        lines.append(f'{metric}_count{{stage="{stage}"}} {hist["count"]}')
+
+    return "\n".join(lines) + "\n"
+
+
+if __name__ == "__main__":
+    print(export_prometheus(), end="")
@@ -0,0 +1,176 @@
+import asyncio
+import os
+import re
+import threading
+import time
+
+from db.db_connection import execute, fetch_df
+
+# How long a snapshot of table versions is trusted before re-reading it
+VERSION_CHECK_INTERVAL = float(os.getenv("TABLE_VERSION_CHECK_INTERVAL", 5))
+
+_IDENT = r'(?:"[^"]+"|\w+)'
+_TABLE_NAME = rf"{_IDENT}(?:\s*\.\s*{_IDENT})?"
+_JOIN_REF = re.compile(rf"\bJOIN\s+({_TABLE_NAME})", re.IGNORECASE)
+_FROM = re.compile(r"\bFROM\b", re.IGNORECASE)
+_FROM_ITEM = re.compile(rf"\s*({_TABLE_NAME})")
+
+# Keywords that end a FROM list (at parenthesis depth 0)
+_FROM_END = re.compile(
+    r"(?:WHERE|GROUP|ORDER|LIMIT|OFFSET|HAVING|WINDOW|UNION|INTERSECT|EXCEPT|FETCH|FOR"
+    r"|JOIN|NATURAL|LEFT|RIGHT|FULL|INNER|CROSS|ON|USING|LATERAL)\b",
+    re.IGNORECASE
+)
+_CTE_NAME = re.compile(rf"(?:\bWITH(?:\s+RECURSIVE)?|,)\s*({_IDENT})\s+AS\s*\(", re.IGNORECASE)
+
+
+def ensure_version_table():
+    execute("""
+    CREATE TABLE IF NOT EXISTS table_versions (
+        table_name TEXT PRIMARY KEY,
+        version BIGINT NOT NULL DEFAULT 0,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    """)
+
+
+
+def _unquote(name: str) -> str:
+    name = name.split(".")[-1].strip()
+    if name.startswith('"'):
+        return name[1:-1]
+    return name.lower()
+
+
+def _from_list(sql: str, start: int) -> list:
+    """Items of the FROM list starting at `start`: `a x, b y` -> ["a x", " b y"]."""
+    items, depth, item_start, i = [], 0, start, start
+
+    while i < len(sql):
+        ch = sql[i]
+
+        if ch == "(":
+            depth += 1
+        elif ch == ")":
+            if depth == 0:
+                break
+            depth -= 1
+        elif depth == 0:
+            if ch == ",":
+                items.append(sql[item_start:i])
+                item_start = i + 1
+            elif ch == ";":
+                break
+            elif ch.isalpha() and not (sql[i - 1].isalnum() or sql[i - 1] == "_") and _FROM_END.match(sql, i):
+                break
+        i += 1
+
+    items.append(sql[item_start:i])
+    return items
+
+
+def extract_tables(sql: str) -> list:
+    """
+    Table names referenced in FROM lists (including `FROM a, b`) and
+    after JOIN, minus CTE names. Subqueries are covered by their own FROM.
+    """
+    ctes = {_unquote(m) for m in _CTE_NAME.findall(sql)}
+    tables = {_unquote(m) for m in _JOIN_REF.findall(sql)}
+
+    for match in _FROM.finditer(sql):
+        for item in _from_list(sql, match.end()):
+            ref = _FROM_ITEM.match(item)
+            if ref:
+                tables.add(_unquote(ref.group(1)))
+
+    return sorted(tables - ctes)
+
+
+_versions = {}
+_versions_at = 0.0
+_versions_lock = threading.Lock()
+
+
+def _load_versions() -> dict:
+    """
+    One cheap catalog read. A table's version changes when the loader
+    bumps table_versions, when it is recreated (new oid) or when
+    pg_stat_user_tables sees rows inserted, updated or deleted.
+    """
+    df = fetch_df("""
+    SELECT c.relname AS table_name,
+           COALESCE(v.version, 0) AS version,
+           c.oid::bigint AS relid,
+           COALESCE(s.n_tup_ins + s.n_tup_upd + s.n_tup_del, 0) AS changes
+    FROM pg_class c
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    LEFT JOIN pg_stat_user_tables s ON s.relid = c.oid
+    LEFT JOIN table_versions v ON v.table_name = c.relname
+    WHERE n.nspname = 'public'
+      AND c.relkind IN ('r', 'v', 'm', 'p')
+    """)
+
+    return {
+        row.table_name: f"{row.version}:{row.relid}:{row.changes}"
+        for row in df.itertuples(index=False)
+    }
+
+
+def current_versions(force: bool = False) -> dict:
+    global _versions, _versions_at
+
+    with _versions_lock:
+        if force or time.time() - _versions_at > VERSION_CHECK_INTERVAL:
+            _versions = _load_versions()
+            _versions_at = time.time()
+
+        return _versions
+
+
+async def refresh_versions_async():
+    """
+    Reload an expired snapshot in a worker thread, so the sync helpers
+    (is_fresh, dependencies_for_sql) then run on the event loop without
+    blocking it on the catalog query.
+    """
+    if time.time() - _versions_at > VERSION_CHECK_INTERVAL:
+        await asyncio.to_thread(current_versions)
+
+
+def dependencies_for_sql(sql: str) -> dict:
+    """
+    {table: data_version} snapshot for the known tables the SQL reads.
+    Take it before running the SQL: a reload racing the query then
+    makes the result look stale, never a stale result look fresh.
+    """
+    versions = current_versions()
+    return {t: versions[t] for t in extract_tables(sql) if t in versions}
+
+
+async def dependencies_for_sql_async(sql: str) -> dict:
+    await refresh_versions_async()
+    return dependencies_for_sql(sql)
+
+
+def is_fresh(deps: dict) -> bool:
+    if not deps:
+        return True
+
+    versions = current_versions()
+    return all(versions.get(table) == version for table, version in deps.items())
+
+
+def bump_table_version(table: str):
+    execute(
+        """
+        INSERT INTO table_versions (table_name, version)
+        VALUES (:table, 1)
+        ON CONFLICT (table_name) DO UPDATE
+        SET version = table_versions.version + 1,
+            updated_at = CURRENT_TIMESTAMP
+        """,
+        {"table": table},
+    )
+
+    # Make the bump visible to this process immediately
+    current_versions(force=True)
@@ -0,0 +1,20 @@
+from cache.tier1_cache import invalidate_l1_tables
+from cache.tier2_cache import invalidate_l2_tables
+from cache.dependencies import bump_table_version
+
+
+def invalidate_tables(tables):
+    """
+    Called after tables are reloaded: bumps their data version and drops
+    only the cached results that read them. Returns L1 entries removed.
+    """
+    tables = sorted(set(tables))
+
+    if not tables:
+        return 0
+
+    for table in tables:
+        bump_table_version(table)
+
+    invalidate_l2_tables(tables)
+    return invalidate_l1_tables(tables)
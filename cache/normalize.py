@@ -0,0 +1,105 @@
+import hashlib
+import re
+import unicodedata
+
+# Bump whenever the normalization rules change so old keys stop matching
+KEY_VERSION = 3
+
+# Filler words that never change which rows a question asks for, but
+# only at the start of a question: later on "in", "to", "is", "me" or
+# "us" can be part of a value ("state_code is IN", "2017 to 2018").
+# Negations, comparisons, quantifiers (all / any) and wh-words
+# (who / what / which) are never dropped.
+STOP_WORDS = frozenset({
+    "a", "an", "the", "please", "me", "us", "can", "could", "would",
+    "you", "i", "we", "to", "do", "does", "is", "are", "was", "were",
+    "be", "of", "for", "in", "on", "that", "there", "kindly", "just",
+    "give", "tell",
+})
+
+# Leading command verbs that only mean "return rows"
+COMMAND_WORDS = frozenset({
+    "show", "list", "display", "get", "fetch", "find", "return",
+    "retrieve", "select", "print", "see",
+})
+
+# Comparison operators and % change the meaning, so they stay as tokens;
+# so do a decimal point between digits (10.5 is not 10 5) and the sign
+# of a negative number (-10 is not 10)
+_PUNCTUATION = re.compile(
+    r"[^\w\s<>=!%.-]|!(?!=)|(?<!\d)\.|\.(?!\d)|-(?!\d)|(?<=[\w.])-"
+)
+_OPERATOR = re.compile(r"!=|[<>=]+|%")
+_WHITESPACE = re.compile(r"\s+")
+
+# Quoted values; an apostrophe inside a word ("customer's") is not a quote
+_QUOTED = re.compile(r"\"([^\"]*)\"|“([^”]*)”|(?<!\w)['‘]([^'’]*)['’](?!\w)")
+
+
+def _fold_unicode(text: str) -> str:
+    text = unicodedata.normalize("NFKD", text)
+    return "".join(ch for ch in text if not unicodedata.combining(ch))
+
+
+def normalize_text(question: str) -> str:
+    """Unicode, case, punctuation and whitespace folding."""
+    text = _fold_unicode(question).casefold()
+    text = _PUNCTUATION.sub(" ", text)
+    text = _OPERATOR.sub(lambda m: f" {m.group(0)} ", text)
+    return _WHITESPACE.sub(" ", text).strip()
+
+
+def _is_caps(word: str) -> bool:
+    letters = [ch for ch in word if ch.isalpha()]
+    return len(letters) >= 2 and all(ch.isupper() for ch in letters)
+
+
+def _words(question: str) -> list:
+    """
+    [(normalized word, protected)]. Quoted words, and all-caps words
+    (codes like IN, ME, US) unless the whole question is shouted, are
+    protected: they are values and are never dropped as filler.
+    """
+    text = _fold_unicode(question)
+    shouted = text == text.upper()
+    words = []
+
+    def add(segment: str, quoted: bool):
+        for raw in segment.split():
+            protected = quoted or (not shouted and _is_caps(raw))
+            words.extend((word, protected) for word in normalize_text(raw).split())
+
+    pos = 0
+    for match in _QUOTED.finditer(text):
+        add(text[pos:match.start()], False)
+        add(next(g for g in match.groups() if g is not None), True)
+        pos = match.end()
+
+    add(text[pos:], False)
+    return words
+
+
+def canonical_question(question: str) -> str:
+    """
+    Canonical form used for cache lookups.
+    Drops leading filler words and command verbs, keeps everything from
+    the first meaningful word on, in order.
+    """
+    words = _words(question)
+    start = 0
+
+    while (
+        start < len(words)
+        and not words[start][1]
+        and (words[start][0] in STOP_WORDS or words[start][0] in COMMAND_WORDS)
+    ):
+        start += 1
+
+    # A question made only of filler words still needs a stable key
+    return " ".join(word for word, _ in words[start:]) or normalize_text(question)
+
+
+def make_cache_key(question: str) -> str:
+    canonical = canonical_question(question)
+    digest = hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+    return f"v{KEY_VERSION}:{digest}"
@@ -0,0 +1,106 @@
+import os
+import threading
+from collections import OrderedDict
+
+from db.db_connection import execute, fetch_one
+
+# Plans are tiny, so keep plenty of them in memory
+MEMORY_MAX_PLANS = int(os.getenv("PLAN_CACHE_MAX_ENTRIES", 10000))
+
+
+def ensure_plan_table():
+    execute("""
+    CREATE TABLE IF NOT EXISTS sql_plan_cache (
+        cache_key TEXT PRIMARY KEY,
+        question TEXT NOT NULL,
+        sql_query TEXT NOT NULL,
+        tables TEXT[] NOT NULL DEFAULT '{}',
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    """)
+
+    execute("""
+    CREATE INDEX IF NOT EXISTS sql_plan_cache_tables_idx
+    ON sql_plan_cache USING GIN (tables);
+    """)
+
+
+
+_plans = OrderedDict()  # cache_key -> (sql, tables)
+_lock = threading.Lock()
+
+
+def _remember(key: str, sql: str, tables: list):
+    with _lock:
+        _plans[key] = (sql, tables)
+        _plans.move_to_end(key)
+
+        while len(_plans) > MEMORY_MAX_PLANS:
+            _plans.popitem(last=False)
+
+
+def get_plan(key: str):
+    """Validated SQL previously generated for this question key, or None."""
+    with _lock:
+        plan = _plans.get(key)
+        if plan is not None:
+            _plans.move_to_end(key)
+            return plan[0]
+
+    row = fetch_one(
+        """
+        SELECT sql_query, tables
+        FROM sql_plan_cache
+        WHERE cache_key = :key
+        """,
+        {"key": key},
+    )
+
+    if row is None:
+        return None
+
+    _remember(key, row["sql_query"], list(row["tables"]))
+    return row["sql_query"]
+
+
+def save_plan(key: str, question: str, sql: str, tables: list):
+    execute(
+        """
+        INSERT INTO sql_plan_cache (cache_key, question, sql_query, tables)
+        VALUES (:key, :question, :sql, :tables)
+        ON CONFLICT (cache_key) DO UPDATE
+        SET sql_query = EXCLUDED.sql_query,
+            tables = EXCLUDED.tables,
+            created_at = CURRENT_TIMESTAMP
+        """,
+        {"key": key, "question": question, "sql": sql, "tables": list(tables)},
+    )
+
+    _remember(key, sql, list(tables))
+
+
+def invalidate_plan(key: str):
+    """Forget one question's plan, e.g. when it no longer runs."""
+    execute("DELETE FROM sql_plan_cache WHERE cache_key = :key", {"key": key})
+
+    with _lock:
+        _plans.pop(key, None)
+
+
+def invalidate_plans(tables):
+    """Forget plans reading any of the given tables (e.g. after a schema change)."""
+    tables = set(tables)
+
+    execute(
+        "DELETE FROM sql_plan_cache WHERE tables && CAST(:tables AS TEXT[])",
+        {"tables": sorted(tables)},
+    )
+
+    with _lock:
+        for key in [k for k, (_, t) in _plans.items() if tables.intersection(t)]:
+            del _plans[key]
+
+
+def clear_plans():
+    with _lock:
+        _plans.clear()
@@ -0,0 +1,111 @@
+import io
+import json
+import os
+
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+# Codec used for new Tier-2 rows: "arrow", "parquet" or "jsonb"
+RESULT_CODEC = os.getenv("RESULT_CODEC", "arrow").lower()
+
+# Compression for binary codecs: "zstd", "lz4" or "none"
+RESULT_COMPRESSION = os.getenv("RESULT_COMPRESSION", "zstd").lower()
+
+# Text codec stored in the result_json JSONB column instead of result_blob
+JSONB_CODEC = "jsonb"
+
+
+def _compression():
+    if RESULT_COMPRESSION in ("", "none"):
+        return None
+    return RESULT_COMPRESSION
+
+
+def _to_arrow(df: pd.DataFrame):
+    return pa.Table.from_pandas(df, preserve_index=False)
+
+
+def encode_arrow(df: pd.DataFrame) -> bytes:
+    table = _to_arrow(df)
+    options = pa.ipc.IpcWriteOptions(compression=_compression())
+    sink = pa.BufferOutputStream()
+
+    with pa.ipc.new_stream(sink, table.schema, options=options) as writer:
+        writer.write_table(table)
+
+    return sink.getvalue().to_pybytes()
+
+
+def decode_arrow(payload: bytes) -> pd.DataFrame:
+    reader = pa.ipc.open_stream(pa.py_buffer(payload))
+    return reader.read_all().to_pandas()
+
+
+def encode_parquet(df: pd.DataFrame) -> bytes:
+    buf = io.BytesIO()
+    pq.write_table(_to_arrow(df), buf, compression=_compression() or "none")
+    return buf.getvalue()
+
+
+def decode_parquet(payload: bytes) -> pd.DataFrame:
+    return pq.read_table(pa.py_buffer(payload)).to_pandas()
+
+
+def encode_jsonb(df: pd.DataFrame) -> str:
+    return df.to_json(orient="records", date_format="iso")
+
+
+def decode_jsonb(payload) -> pd.DataFrame:
+    if isinstance(payload, (str, bytes)):
+        payload = json.loads(payload)
+    return pd.DataFrame(payload)
+
+
+_codecs = {
+    JSONB_CODEC: (encode_jsonb, decode_jsonb),
+}
+
+if pa is not None:
+    _codecs["arrow"] = (encode_arrow, decode_arrow)
+    _codecs["parquet"] = (encode_parquet, decode_parquet)
+
+
+def register_codec(name: str, encode, decode):
+    """Add a codec: encode(df) -> bytes, decode(bytes) -> df."""
+    _codecs[name] = (encode, decode)
+
+
+def available_codecs() -> list:
+    return list(_codecs)
+
+
+def encode_result(df: pd.DataFrame, codec: str = None):
+    """
+    Returns (codec_name, payload). Falls back to JSONB when the requested
+    codec is unavailable or cannot represent the frame's column types.
+    """
+    codec = codec or RESULT_CODEC
+
+    if codec in _codecs and codec != JSONB_CODEC:
+        encode, _ = _codecs[codec]
+        try:
+            return codec, encode(df)
+        except Exception:
+            # e.g. mixed-type object columns Arrow cannot type
+            pass
+
+    return JSONB_CODEC, encode_jsonb(df)
+
+
+def decode_result(codec: str, payload) -> pd.DataFrame:
+    if codec not in _codecs:
+        raise ValueError(f"Unknown result codec: {codec}")
+
+    _, decode = _codecs[codec]
+    return decode(payload)
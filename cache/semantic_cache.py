@@ -0,0 +1,274 @@
+import os
+import re
+import threading
+import zlib
+
+import numpy as np
+
+from db.db_connection import execute, fetch_df
+from cache.normalize import canonical_question
+
+SIMILARITY_THRESHOLD = float(os.getenv("SEMANTIC_THRESHOLD", 0.95))
+EMBEDDER = os.getenv("SEMANTIC_EMBEDDER", "openai").lower()
+
+_NUMBER = re.compile(r"\d+(?:\.\d+)?")
+
+
+class Embedder:
+    """Turns texts into L2-normalized float32 vectors, one row per text."""
+
+    name = "base"
+
+    def embed(self, texts: list) -> np.ndarray:
+        raise NotImplementedError
+
+
+class HashingEmbedder(Embedder):
+    """
+    Deterministic local embedder (hashed word and character n-grams).
+    Needs no network, so it suits tests and offline benchmarks.
+    """
+
+    def __init__(self, dim: int = 512):
+        self.dim = dim
+        self.name = f"hashing-{dim}"
+
+    def _features(self, text: str):
+        words = text.split()
+        yield from words
+        yield from (f"{a} {b}" for a, b in zip(words, words[1:]))
+        padded = f" {text} "
+        yield from (padded[i:i + 3] for i in range(len(padded) - 2))
+
+    def embed(self, texts: list) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+
+        for row, text in enumerate(texts):
+            for feature in self._features(text):
+                h = zlib.crc32(feature.encode("utf-8"))
+                sign = 1.0 if h & 0x80000000 else -1.0
+                vectors[row, h % self.dim] += sign
+
+        return _normalize(vectors)
+
+
+class OpenAIEmbedder(Embedder):
+
+    def __init__(self, model: str = "text-embedding-3-small"):
+        from langchain_openai import OpenAIEmbeddings
+
+        self.client = OpenAIEmbeddings(model=model)
+        self.name = f"openai-{model}"
+
+    def embed(self, texts: list) -> np.ndarray:
+        vectors = np.asarray(self.client.embed_documents(texts), dtype=np.float32)
+        return _normalize(vectors)
+
+
+class BruteForceIndex:
+    """
+    Exact cosine search as one matrix-vector product over all stored rows.
+    Any object with the same add/search/clear methods (e.g. an ANN
+    library wrapper) can be plugged in via set_index_factory().
+    """
+
+    def __init__(self, dim: int):
+        self.dim = dim
+        self.keys = []
+        self.matrix = np.empty((0, dim), dtype=np.float32)
+        self._size = 0
+
+    def add(self, keys: list, vectors: np.ndarray):
+        needed = self._size + len(keys)
+
+        if needed > len(self.matrix):
+            grown = np.empty((max(needed, 2 * len(self.matrix), 64), self.dim), dtype=np.float32)
+            grown[:self._size] = self.matrix[:self._size]
+            self.matrix = grown
+
+        self.matrix[self._size:needed] = vectors
+        self.keys.extend(keys)
+        self._size = needed
+
+    def search(self, vector: np.ndarray, k: int = 1):
+        if self._size == 0:
+            return []
+
+        scores = self.matrix[:self._size] @ vector
+        k = min(k, self._size)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+
+        return [(self.keys[i], float(scores[i])) for i in top]
+
+    def clear(self):
+        self.keys = []
+        self.matrix = np.empty((0, self.dim), dtype=np.float32)
+        self._size = 0
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def ensure_semantic_table():
+    execute("""
+    CREATE TABLE IF NOT EXISTS semantic_cache (
+        cache_key TEXT PRIMARY KEY,
+        question TEXT NOT NULL,
+        embedder TEXT NOT NULL,
+        embedding BYTEA NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    """)
+
+
+
+_lock = threading.Lock()
+_embedder = None
+_index = None
+_index_factory = BruteForceIndex
+_questions = {}
+
+
+def _default_embedder() -> Embedder:
+    if EMBEDDER == "hashing":
+        return HashingEmbedder()
+    return OpenAIEmbedder()
+
+
+def get_embedder() -> Embedder:
+    global _embedder
+    if _embedder is None:
+        _embedder = _default_embedder()
+    return _embedder
+
+
+def set_embedder(embedder: Embedder):
+    """Swap the embedder; the in-memory index is reloaded on next use."""
+    global _embedder, _index
+    with _lock:
+        _embedder = embedder
+        _index = None
+        _questions.clear()
+
+
+def set_index_factory(factory):
+    """factory(dim) -> index object with add/search/clear."""
+    global _index_factory, _index
+    with _lock:
+        _index_factory = factory
+        _index = None
+        _questions.clear()
+
+
+def _load_index():
+    global _index
+
+    if _index is not None:
+        return _index
+
+    embedder = get_embedder()
+
+    df = fetch_df(
+        """
+        SELECT cache_key, question, embedding
+        FROM semantic_cache
+        WHERE embedder = :embedder
+        """,
+        {"embedder": embedder.name},
+    )
+
+    vectors = [np.frombuffer(bytes(b), dtype=np.float32) for b in df["embedding"]]
+    dim = len(vectors[0]) if vectors else embedder.embed(["probe"]).shape[1]
+
+    index = _index_factory(dim)
+    if vectors:
+        index.add(list(df["cache_key"]), np.vstack(vectors))
+
+    _questions.update(zip(df["cache_key"], df["question"]))
+    _index = index
+    return index
+
+
+def _same_literals(a: str, b: str) -> bool:
+    # Embeddings blur numbers ("top 5" vs "top 50"), so require them to match
+    return _NUMBER.findall(a) == _NUMBER.findall(b)
+
+
+def find_similar(question: str, threshold: float = None):
+    """
+    Returns (cache_key, matched_question, score) for the closest cached
+    question above the threshold, otherwise None. Best-effort: when the
+    embedder or the index fails (API outage, rate limit) the tier is a miss.
+    """
+    try:
+        return _find_similar(question, threshold)
+    except Exception as e:
+        print(f"Semantic cache lookup failed, treating as a miss: {e}")
+        return None
+
+
+def _find_similar(question: str, threshold: float = None):
+    threshold = SIMILARITY_THRESHOLD if threshold is None else threshold
+    canonical = canonical_question(question)
+    vector = get_embedder().embed([canonical])[0]
+
+    with _lock:
+        index = _load_index()
+        matches = index.search(vector, k=1)
+
+        if not matches:
+            return None
+
+        key, score = matches[0]
+        matched = _questions.get(key, "")
+
+    if score < threshold or not _same_literals(canonical, canonical_question(matched)):
+        return None
+
+    return key, matched, score
+
+
+def add_question(key: str, question: str):
+    """
+    Index a newly answered question. Best-effort: a failure is logged
+    and never discards the answer that was just produced.
+    """
+    try:
+        _add_question(key, question)
+    except Exception as e:
+        print(f"Semantic cache indexing failed for {question!r}: {e}")
+
+
+def _add_question(key: str, question: str):
+    embedder = get_embedder()
+    vector = embedder.embed([canonical_question(question)])[0].astype(np.float32)
+
+    execute(
+        """
+        INSERT INTO semantic_cache (cache_key, question, embedder, embedding)
+        VALUES (:key, :question, :embedder, :embedding)
+        ON CONFLICT (cache_key) DO NOTHING
+        """,
+        {
+            "key": key,
+            "question": question,
+            "embedder": embedder.name,
+            "embedding": vector.tobytes(),
+        },
+    )
+
+    with _lock:
+        if _index is not None and key not in _questions:
+            _index.add([key], vector[np.newaxis, :])
+            _questions[key] = question
+
+
+def clear_semantic():
+    with _lock:
+        if _index is not None:
+            _index.clear()
+        _questions.clear()
@@ -0,0 +1,124 @@
+import asyncio
+import threading
+import hashlib
+from concurrent.futures import Future
+from contextlib import asynccontextmanager, contextmanager
+
+from sqlalchemy import text
+
+from db.db_connection import get_async_lock_engine, get_lock_engine
+
+
+class SingleFlight:
+    """
+    Collapses concurrent calls for the same key into one execution.
+    The first caller runs fn(); everyone else arriving while it runs
+    waits and receives the same result or exception.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def _join(self, key: str):
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+
+            if leader:
+                future = Future()
+                self._calls[key] = future
+
+        return future, leader
+
+    def _done(self, key: str):
+        with self._lock:
+            del self._calls[key]
+
+    def do(self, key: str, fn):
+        """Returns (result, shared) where shared is True for followers."""
+        future, leader = self._join(key)
+
+        if not leader:
+            return future.result(), True
+
+        try:
+            result = fn()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            self._done(key)
+
+    async def do_async(self, key: str, coro_fn):
+        """
+        Async twin of do(). Shares the same in-flight table, so sync and
+        async callers (on any thread or event loop) coalesce together.
+        """
+        future, leader = self._join(key)
+
+        if not leader:
+            return await asyncio.wrap_future(future), True
+
+        try:
+            result = await coro_fn()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            self._done(key)
+
+    def in_flight(self) -> int:
+        with self._lock:
+            return len(self._calls)
+
+
+def _lock_id(key: str) -> int:
+    # pg_advisory_lock takes a signed 64-bit id; 32 bits collide too often
+    digest = hashlib.sha256(key.encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big", signed=True)
+
+
+@contextmanager
+def advisory_lock(key: str):
+    """
+    Cross-process variant: holds a Postgres session-level advisory lock
+    for the query_cache key, so only one worker fills a miss at a time.
+    """
+    lock_id = _lock_id(key)
+
+    with get_lock_engine().connect() as conn:
+        conn.execute(text("SELECT pg_advisory_lock(:id)"), {"id": lock_id})
+        try:
+            yield
+        finally:
+            conn.execute(text("SELECT pg_advisory_unlock(:id)"), {"id": lock_id})
+
+
+@asynccontextmanager
+async def advisory_lock_async(key: str):
+    lock_id = _lock_id(key)
+
+    async with get_async_lock_engine().connect() as conn:
+        await conn.execute(text("SELECT pg_advisory_lock(:id)"), {"id": lock_id})
+        try:
+            yield
+        finally:
+            await conn.execute(text("SELECT pg_advisory_unlock(:id)"), {"id": lock_id})
+
+
+_flight = SingleFlight()
+
+
+def single_flight(key: str, fn):
+    return _flight.do(key, fn)
+
+
+async def single_flight_async(key: str, coro_fn):
+    return await _flight.do_async(key, coro_fn)
@@ -1,30 +1,244 @@
+import os
+import sys
+import threading
 import time
+import zlib
+from collections import OrderedDict
 
-# In-memory store
-_cache = {}
+from cache.cache_metrics import record_l1_eviction, set_l1_size
 
-DEFAULT_TTL = 300  # seconds (5 minutes)
+# Entries are also dropped as soon as a table they read changes,
+# so the TTL only bounds how long unrelated results linger.
+DEFAULT_TTL = int(os.getenv("L1_TTL", 3600))  # seconds (1 hour)
 
+MAX_BYTES = int(os.getenv("L1_MAX_BYTES", 256 * 1024 * 1024))  # 256 MB
+POLICY = os.getenv("L1_POLICY", "lru").lower()  # "lru" or "lfu"
+NUM_SHARDS = int(os.getenv("L1_SHARDS", 16))
+SWEEP_INTERVAL = float(os.getenv("L1_SWEEP_INTERVAL", 60))  # seconds
 
-def get_l1(question: str):
-    entry = _cache.get(question)
+# LFU is approximated Redis-style: evict the least frequently used
+# entry among the N least recently used ones.
+LFU_SAMPLE = 8
 
-    if not entry:
-        return None
 
-    sql, df, expiry = entry
+class _Entry:
+    __slots__ = ("sql", "df", "expiry", "size", "hits", "deps")
+
+    def __init__(self, sql, df, expiry, size, deps=None):
+        self.sql = sql
+        self.df = df
+        self.expiry = expiry
+        self.size = size
+        self.hits = 0
+        self.deps = deps or {}
+
+
+class _Shard:
+
+    def __init__(self, max_bytes: int):
+        self.lock = threading.Lock()
+        self.items = OrderedDict()
+        self.bytes = 0
+        self.max_bytes = max_bytes
+
+    def _remove(self, key):
+        entry = self.items.pop(key)
+        self.bytes -= entry.size
+        return entry
+
+    def _pick_victim(self):
+        if POLICY != "lfu":
+            return next(iter(self.items))
+
+        victim, victim_hits = None, None
+        for i, (key, entry) in enumerate(self.items.items()):
+            if i >= LFU_SAMPLE:
+                break
+            if victim is None or entry.hits < victim_hits:
+                victim, victim_hits = key, entry.hits
+        return victim
+
+    def get(self, key, now):
+        with self.lock:
+            entry = self.items.get(key)
+
+            if entry is None:
+                return None
+
+            if now > entry.expiry:
+                self._remove(key)
+                return None
+
+            entry.hits += 1
+            self.items.move_to_end(key)
+            return entry
+
+    def put(self, key, entry):
+        """Insert entry, returning the number of evicted entries."""
+        evicted = 0
+
+        with self.lock:
+            if key in self.items:
+                self._remove(key)
+
+            while self.items and self.bytes + entry.size > self.max_bytes:
+                self._remove(self._pick_victim())
+                evicted += 1
+
+            self.items[key] = entry
+            self.bytes += entry.size
+
+        return evicted
+
+    def pop(self, key):
+        with self.lock:
+            if key in self.items:
+                self._remove(key)
+
+    def drop_dependents(self, tables):
+        with self.lock:
+            stale = [k for k, e in self.items.items() if tables.intersection(e.deps)]
+            for key in stale:
+                self._remove(key)
+        return len(stale)
+
+    def sweep(self, now):
+        with self.lock:
+            expired = [k for k, e in self.items.items() if now > e.expiry]
+            for key in expired:
+                self._remove(key)
+        return len(expired)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.bytes = 0
+
+
+_shards = [_Shard(MAX_BYTES // NUM_SHARDS) for _ in range(NUM_SHARDS)]
+
+_sweeper = None
+_sweeper_lock = threading.Lock()
+
+
+def _shard_for(key: str) -> _Shard:
+    return _shards[zlib.crc32(key.encode()) % NUM_SHARDS]
+
+
+def estimate_size(sql: str, df) -> int:
+    """Approximate memory held by a cached entry, in bytes."""
+    size = sys.getsizeof(sql)
+
+    if df is not None:
+        size += int(df.memory_usage(deep=True, index=True).sum())
 
-    if time.time() > expiry:
-        del _cache[question]
+    return size
+
+
+def _publish_size():
+    set_l1_size(
+        sum(s.bytes for s in _shards),
+        sum(len(s.items) for s in _shards)
+    )
+
+
+def _sweep_loop():
+    while True:
+        time.sleep(SWEEP_INTERVAL)
+        sweep_expired()
+
+
+def _ensure_sweeper():
+    global _sweeper
+
+    if _sweeper is not None:
+        return
+
+    with _sweeper_lock:
+        if _sweeper is None:
+            _sweeper = threading.Thread(
+                target=_sweep_loop,
+                name="l1-cache-sweeper",
+                daemon=True
+            )
+            _sweeper.start()
+
+
+def sweep_expired() -> int:
+    """Drop every expired entry. Returns the number of entries removed."""
+    now = time.time()
+    removed = sum(shard.sweep(now) for shard in _shards)
+
+    if removed:
+        _publish_size()
+
+    return removed
+
+
+def get_l1(question: str, is_fresh=None):
+    """
+    is_fresh(deps) -> bool lets the caller reject entries whose
+    source tables changed since they were cached.
+    """
+    shard = _shard_for(question)
+    entry = shard.get(question, time.time())
+
+    if entry is None:
         return None
 
-    return sql, df
+    if is_fresh is not None and not is_fresh(entry.deps):
+        shard.pop(question)
+        _publish_size()
+        return None
+
+    return entry.sql, entry.df
+
+
+def set_l1(question: str, sql: str, df, ttl=DEFAULT_TTL, deps: dict = None):
+    _ensure_sweeper()
+
+    shard = _shard_for(question)
+    size = estimate_size(sql, df)
+
+    # Never let a single result flush a whole shard
+    if size > shard.max_bytes:
+        shard.pop(question)
+        _publish_size()
+        return False
+
+    entry = _Entry(sql, df, time.time() + ttl, size, deps)
+    evicted = shard.put(question, entry)
 
+    if evicted:
+        record_l1_eviction(evicted)
 
-def set_l1(question: str, sql: str, df, ttl=DEFAULT_TTL):
-    expiry = time.time() + ttl
-    _cache[question] = (sql, df, expiry)
+    _publish_size()
+    return True
+
+
+def invalidate_l1_tables(tables) -> int:
+    """Drop entries that read any of the given tables."""
+    tables = set(tables)
+    removed = sum(shard.drop_dependents(tables) for shard in _shards)
+
+    if removed:
+        _publish_size()
+
+    return removed
 
 
 def clear_l1():
-    _cache.clear()
+    for shard in _shards:
+        shard.clear()
+
+    _publish_size()
+
+
+def l1_stats():
+    return {
+        "entries": sum(len(s.items) for s in _shards),
+        "bytes": sum(s.bytes for s in _shards),
+        "max_bytes": MAX_BYTES,
+        "policy": POLICY,
+        "shards": NUM_SHARDS,
+    }
@@ -1,9 +1,52 @@
-import hashlib
+import atexit
 import json
+import os
+import threading
+import time
+from collections import Counter
 
 import pandas as pd
 
-from db.db_connection import execute, fetch_df
+from db.db_connection import (
+    execute,
+    execute_async,
+    fetch_df,
+    fetch_df_async,
+    fetch_one,
+    fetch_one_async
+)
+from cache.normalize import make_cache_key
+from cache.result_codec import JSONB_CODEC, decode_result, encode_result
+from cache.dependencies import is_fresh
+from cache.write_behind import WriteBehindQueue
+
+# Results are cheap to rebuild from the SQL plan cache, so keep them short-lived
+RESULT_TTL = int(os.getenv("L2_RESULT_TTL", 24 * 3600))  # seconds (default per-entry TTL)
+
+# Size budget for the whole table: total encoded payload and total result rows.
+# The eviction job trims back to L2_EVICT_TARGET of the budget when over it
+MAX_BYTES = int(os.getenv("L2_MAX_MB", 1024)) * 1024 * 1024
+MAX_ROWS = int(os.getenv("L2_MAX_ROWS", 5_000_000))
+EVICT_TARGET = float(os.getenv("L2_EVICT_TARGET", 0.9))
+
+# Encoded results larger than this are not stored at all
+MAX_ENTRY_BYTES = int(os.getenv("L2_MAX_ENTRY_MB", 8)) * 1024 * 1024
+
+EVICT_INTERVAL = float(os.getenv("L2_EVICT_INTERVAL", 300))  # seconds
+EVICT_BATCH = int(os.getenv("L2_EVICT_BATCH", 500))  # rows per DELETE
+
+# LFU with aging: a hit this many hours ago counts half as much as one now
+EVICT_HALF_LIFE_HOURS = float(os.getenv("L2_EVICT_HALF_LIFE_HOURS", 24))
+
+# Saves are queued and persisted in batches by a background thread
+WRITE_BEHIND = os.getenv("L2_WRITE_BEHIND", "1") == "1"
+WRITE_BEHIND_MAX_BYTES = int(os.getenv("L2_WRITE_BEHIND_MAX_MB", 128)) * 1024 * 1024
+WRITE_BEHIND_BATCH = int(os.getenv("L2_WRITE_BEHIND_BATCH", 50))
+WRITE_BEHIND_INTERVAL = float(os.getenv("L2_WRITE_BEHIND_INTERVAL", 0.5))  # seconds
+
+# Hits are counted in memory and written in one UPDATE per interval,
+# never on the request path
+HIT_FLUSH_INTERVAL = float(os.getenv("L2_HIT_FLUSH_INTERVAL", 10))  # seconds
 
 
 def ensure_cache_table():
@@ -27,7 +70,16 @@ def ensure_cache_table():
             question TEXT NOT NULL,
             sql_query TEXT NOT NULL,
             result_json JSONB,
+            result_blob BYTEA,
+            result_codec TEXT NOT NULL DEFAULT 'jsonb',
             row_count INTEGER,
+            tables TEXT[] NOT NULL DEFAULT '{}',
+            table_versions JSONB NOT NULL DEFAULT '{}',
+            execution_ms DOUBLE PRECISION,
+            hit_count INTEGER NOT NULL DEFAULT 0,
+            last_hit_at TIMESTAMP,
+            payload_bytes BIGINT NOT NULL DEFAULT 0,
+            expires_at TIMESTAMP,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         );
         """
@@ -36,59 +88,537 @@ def ensure_cache_table():
 
         print("query_cache table created")
 
+    else:
+        # Tables created before binary results / dependency tracking existed
+        execute("""
+        ALTER TABLE query_cache
+            ADD COLUMN IF NOT EXISTS result_blob BYTEA,
+            ADD COLUMN IF NOT EXISTS result_codec TEXT NOT NULL DEFAULT 'jsonb',
+            ADD COLUMN IF NOT EXISTS tables TEXT[] NOT NULL DEFAULT '{}',
+            ADD COLUMN IF NOT EXISTS table_versions JSONB NOT NULL DEFAULT '{}',
+            ADD COLUMN IF NOT EXISTS execution_ms DOUBLE PRECISION,
+            ADD COLUMN IF NOT EXISTS hit_count INTEGER NOT NULL DEFAULT 0,
+            ADD COLUMN IF NOT EXISTS last_hit_at TIMESTAMP,
+            ADD COLUMN IF NOT EXISTS payload_bytes BIGINT NOT NULL DEFAULT 0,
+            ADD COLUMN IF NOT EXISTS expires_at TIMESTAMP;
+        """)
+
+        # Rows written before sizes / per-entry TTLs were recorded
+        execute("""
+        UPDATE query_cache
+        SET payload_bytes = COALESCE(octet_length(result_blob), octet_length(result_json::text), 0),
+            expires_at = created_at + make_interval(secs => :ttl)
+        WHERE expires_at IS NULL
+        """, {"ttl": RESULT_TTL})
+
+    execute("""
+    CREATE INDEX IF NOT EXISTS query_cache_tables_idx
+    ON query_cache USING GIN (tables);
+    """)
+
+    execute("""
+    CREATE INDEX IF NOT EXISTS query_cache_expires_at_idx
+    ON query_cache (expires_at);
+    """)
+
+    # Hit-count updates touch no indexed column, so with free space on
+    # each page they stay HOT; vacuum early since rows churn constantly
+    execute("""
+    ALTER TABLE query_cache SET (fillfactor = 90, autovacuum_vacuum_scale_factor = 0.05);
+    """)
 
-ensure_cache_table()
 
 
 def make_key(question: str) -> str:
-    return hashlib.sha256(question.strip().lower().encode()).hexdigest()
+    return make_cache_key(question)
+
+
+def _decode_row(row) -> pd.DataFrame:
+    codec = row["result_codec"] or JSONB_CODEC
+
+    if codec == JSONB_CODEC:
+        return decode_result(codec, row["result_json"])
+
+    return decode_result(codec, bytes(row["result_blob"]))
 
 
 def get_cached_result(question: str):
-    key = make_key(question)
+    return get_cached_result_by_key(make_key(question))
 
-    query = """
-    SELECT sql_query, result_json
-    FROM query_cache
-    WHERE cache_key = :key
-    """
 
-    df = fetch_df(query, {"key": key})
+_SELECT_RESULT = """
+SELECT sql_query, result_codec, result_blob, result_json, table_versions
+FROM query_cache
+WHERE cache_key = :key
+  AND expires_at > CURRENT_TIMESTAMP
+"""
 
-    if df.empty:
+_DELETE_RESULT = "DELETE FROM query_cache WHERE cache_key = :key"
+
+_UPSERT_COLUMNS = """
+INSERT INTO query_cache
+(cache_key, question, sql_query, result_json, result_blob, result_codec,
+ row_count, tables, table_versions, execution_ms, payload_bytes, expires_at)
+VALUES
+"""
+
+_UPSERT_VALUES = """(:key{i}, :question{i}, :sql{i}, CAST(:result_json{i} AS JSONB), :result_blob{i},
+ :codec{i}, :count{i}, :tables{i}, CAST(:versions{i} AS JSONB), :execution_ms{i},
+ :payload_bytes{i}, CURRENT_TIMESTAMP + make_interval(secs => :ttl{i}))"""
+
+_UPSERT_CONFLICT = """
+ON CONFLICT (cache_key) DO UPDATE
+SET sql_query = EXCLUDED.sql_query,
+    result_json = EXCLUDED.result_json,
+    result_blob = EXCLUDED.result_blob,
+    result_codec = EXCLUDED.result_codec,
+    row_count = EXCLUDED.row_count,
+    tables = EXCLUDED.tables,
+    table_versions = EXCLUDED.table_versions,
+    execution_ms = EXCLUDED.execution_ms,
+    payload_bytes = EXCLUDED.payload_bytes,
+    expires_at = EXCLUDED.expires_at,
+    created_at = CURRENT_TIMESTAMP
+"""
+
+_UPSERT_RESULT = _UPSERT_COLUMNS + _UPSERT_VALUES.format(i="") + _UPSERT_CONFLICT
+
+
+def _upsert_many_sql(n: int) -> str:
+    return _UPSERT_COLUMNS + ",\n".join(_UPSERT_VALUES.format(i=i) for i in range(n)) + _UPSERT_CONFLICT
+
+
+def _row_is_fresh(row) -> bool:
+    deps = row["table_versions"]
+    if isinstance(deps, str):
+        deps = json.loads(deps)
+
+    # False when a table this result reads has changed since it was cached
+    return is_fresh(deps)
+
+
+_stats = Counter()
+
+
+def _save_params(question: str, sql: str, result_df: pd.DataFrame, deps: dict,
+                 ttl: int = None):
+    """Upsert parameters, or None when the encoded result is over MAX_ENTRY_BYTES."""
+    deps = deps or {}
+    codec, payload = encode_result(result_df)
+    size = len(payload.encode() if isinstance(payload, str) else payload)
+
+    if size > MAX_ENTRY_BYTES:
+        print(f"L2: not caching {size} byte result for {question!r} (limit {MAX_ENTRY_BYTES})")
+        _stats["refused"] += 1
         return None
 
-    sql = df.iloc[0]["sql_query"]
-    result_json = df.iloc[0]["result_json"]
+    return {
+        "key": make_key(question),
+        "question": question,
+        "sql": sql,
+        "result_json": payload if codec == JSONB_CODEC else None,
+        "result_blob": payload if codec != JSONB_CODEC else None,
+        "codec": codec,
+        "count": len(result_df),
+        "tables": sorted(deps),
+        "versions": json.dumps(deps),
+        # Mined by db/index_advisor.py
+        "execution_ms": result_df.attrs.get("execution_ms"),
+        "payload_bytes": size,
+        "ttl": ttl or RESULT_TTL,
+    }
 
-    if isinstance(result_json, str):
-        result_json = json.loads(result_json)
 
-    result_df = pd.DataFrame(result_json)
+def save_many_to_cache(entries: list):
+    """[(question, sql, df, deps, ttl)] in a single multi-row upsert."""
+    rows = [p for p in (_save_params(*entry) for entry in entries) if p is not None]
+    if not rows:
+        return
 
-    return sql, result_df
+    params = {}
+    for i, row in enumerate(rows):
+        params.update({f"{k}{i}": v for k, v in row.items()})
 
+    execute(_upsert_many_sql(len(rows)), params)
 
-def save_to_cache(question: str, sql: str, result_df: pd.DataFrame):
-    key = make_key(question)
 
-    result_json = result_df.to_dict(orient="records")
-    row_count = len(result_df)
+_writes = WriteBehindQueue(
+    save_many_to_cache,
+    name="l2-write-behind",
+    max_bytes=WRITE_BEHIND_MAX_BYTES,
+    batch_size=WRITE_BEHIND_BATCH,
+    interval=WRITE_BEHIND_INTERVAL
+)
 
-    insert = """
-    INSERT INTO query_cache
-    (cache_key, question, sql_query, result_json, row_count)
-    VALUES (:key, :question, :sql, CAST(:result AS JSONB), :count)
-    ON CONFLICT (cache_key) DO NOTHING
-    """
+
+def _queue_save(question: str, sql: str, result_df: pd.DataFrame, deps: dict, ttl: int = None):
+    # Encoding happens on the writer thread too, not on the request path
+    size = int(result_df.memory_usage(deep=True).sum())
+    _writes.put(make_key(question), (question, sql, result_df, deps or {}, ttl), size)
+
+
+def _pending_result(key: str):
+    """Read-your-writes: a queued, still fresh save for this key."""
+    entry = _writes.get(key)
+
+    if entry is None or not is_fresh(entry[3]):
+        return None
+
+    return entry[1], entry[2]
+
+
+def flush_writes(timeout: float = 10.0) -> bool:
+    return _writes.flush(timeout)
+
+
+def write_behind_stats() -> dict:
+    return _writes.stats()
+
+
+def get_cached_result_by_key(key: str):
+    pending = _pending_result(key)
+    if pending:
+        return pending
+
+    row = fetch_one(_SELECT_RESULT, {"key": key})
+
+    if row is None:
+        return None
+
+    if not _row_is_fresh(row):
+        execute(_DELETE_RESULT, {"key": key})
+        return None
+
+    return row["sql_query"], _decode_row(row)
+
+
+def save_to_cache(question: str, sql: str, result_df: pd.DataFrame, deps: dict = None,
+                  ttl: int = None):
+    """Store a result for `ttl` seconds (default L2_RESULT_TTL)."""
+    _ensure_evictor()
+
+    if WRITE_BEHIND:
+        _queue_save(question, sql, result_df, deps, ttl)
+        return
+
+    params = _save_params(question, sql, result_df, deps, ttl)
+    if params is not None:
+        execute(_UPSERT_RESULT, params)
+
+
+async def get_cached_result_async(question: str):
+    return await get_cached_result_by_key_async(make_key(question))
+
+
+async def get_cached_result_by_key_async(key: str):
+    pending = _pending_result(key)
+    if pending:
+        return pending
+
+    row = await fetch_one_async(_SELECT_RESULT, {"key": key})
+
+    if row is None:
+        return None
+
+    if not _row_is_fresh(row):
+        await execute_async(_DELETE_RESULT, {"key": key})
+        return None
+
+    return row["sql_query"], _decode_row(row)
+
+
+async def get_cached_results_async(keys: list) -> dict:
+    """Bulk lookup: {cache_key: (sql, df)} for fresh hits, in one round trip."""
+    if not keys:
+        return {}
+
+    hits = {}
+    for key in keys:
+        pending = _pending_result(key)
+        if pending:
+            hits[key] = pending
+
+    keys = [k for k in keys if k not in hits]
+    if not keys:
+        return hits
+
+    df = await fetch_df_async(
+        """
+        SELECT cache_key, sql_query, result_codec, result_blob, result_json, table_versions
+        FROM query_cache
+        WHERE cache_key = ANY(:keys)
+          AND expires_at > CURRENT_TIMESTAMP
+        """,
+        {"keys": list(keys)},
+    )
+
+    stale = []
+
+    for row in df.to_dict(orient="records"):
+        if _row_is_fresh(row):
+            hits[row["cache_key"]] = (row["sql_query"], _decode_row(row))
+        else:
+            stale.append(row["cache_key"])
+
+    if stale:
+        await execute_async(
+            "DELETE FROM query_cache WHERE cache_key = ANY(:keys)",
+            {"keys": stale},
+        )
+
+    return hits
+
+
+async def save_to_cache_async(question: str, sql: str, result_df: pd.DataFrame, deps: dict = None,
+                              ttl: int = None):
+    _ensure_evictor()
+
+    if WRITE_BEHIND:
+        # Returns immediately; the row lands with the next batch
+        _queue_save(question, sql, result_df, deps, ttl)
+        return
+
+    params = _save_params(question, sql, result_df, deps, ttl)
+    if params is not None:
+        await execute_async(_UPSERT_RESULT, params)
+
+
+_RECORD_HITS = """
+UPDATE query_cache q
+SET hit_count = q.hit_count + h.n,
+    last_hit_at = CURRENT_TIMESTAMP
+FROM unnest(CAST(:keys AS TEXT[]), CAST(:counts AS INTEGER[])) AS h(cache_key, n)
+WHERE q.cache_key = h.cache_key
+"""
+
+_pending_hits = Counter()
+_hits_lock = threading.Lock()
+_hit_flusher = None
+
+
+def record_hit(key: str):
+    """Count a cache hit (any tier) for this key; persisted in the background."""
+    with _hits_lock:
+        _pending_hits[key] += 1
+
+    _ensure_hit_flusher()
+
+
+def flush_hits() -> int:
+    """Write the pending hit counts. Returns the number of keys updated."""
+    with _hits_lock:
+        pending = dict(_pending_hits)
+        _pending_hits.clear()
+
+    if not pending:
+        return 0
+
+    execute(_RECORD_HITS, {"keys": list(pending), "counts": list(pending.values())})
+    return len(pending)
+
+
+def _hit_flush_loop():
+    while True:
+        time.sleep(HIT_FLUSH_INTERVAL)
+        try:
+            flush_hits()
+        except Exception as e:
+            print(f"L2 hit flush failed: {e}")
+
+
+def _ensure_hit_flusher():
+    global _hit_flusher
+
+    if _hit_flusher is not None:
+        return
+
+    with _hits_lock:
+        if _hit_flusher is None:
+            _hit_flusher = threading.Thread(
+                target=_hit_flush_loop,
+                name="l2-hit-flusher",
+                daemon=True
+            )
+            _hit_flusher.start()
+            atexit.register(flush_hits)
+
+
+def invalidate_l2_tables(tables) -> None:
+    """Delete cached results that read any of the given tables."""
+    tables = set(tables)
+    _writes.discard(lambda entry: tables & set(entry[3]))
 
     execute(
-        insert,
-        {
-            "key": key,
-            "question": question,
-            "sql": sql,
-            "result": json.dumps(result_json),
-            "count": row_count,
-        },
+        "DELETE FROM query_cache WHERE tables && CAST(:tables AS TEXT[])",
+        {"tables": list(tables)},
+    )
+
+
+_DELETE_EXPIRED = """
+DELETE FROM query_cache
+WHERE cache_key IN (
+    SELECT cache_key
+    FROM query_cache
+    WHERE expires_at <= CURRENT_TIMESTAMP
+    LIMIT :limit
+)
+"""
+
+_TOTALS = """
+SELECT CAST(COALESCE(sum(payload_bytes), 0) AS BIGINT) AS payload_bytes,
+       CAST(COALESCE(sum(row_count), 0) AS BIGINT) AS result_rows
+FROM query_cache
+"""
+
+# Lowest score first (hit count decayed by time since the last hit),
+# as many as it takes to free the excess bytes and rows
+_EVICTION_CANDIDATES = """
+SELECT cache_key
+FROM (
+    SELECT cache_key,
+           sum(payload_bytes) OVER w - payload_bytes AS bytes_before,
+           sum(COALESCE(row_count, 0)) OVER w - COALESCE(row_count, 0) AS rows_before
+    FROM query_cache
+    WINDOW w AS (
+        ORDER BY (hit_count + 1) * power(
+            0.5,
+            EXTRACT(EPOCH FROM CURRENT_TIMESTAMP - COALESCE(last_hit_at, created_at))
+            / (:half_life * 3600)
+        ), cache_key
     )
+) ranked
+WHERE bytes_before < :excess_bytes OR rows_before < :excess_rows
+"""
+
+_evict_lock = threading.Lock()
+_evictor = None
+
+
+def evict_l2(max_bytes: int = MAX_BYTES, max_rows: int = MAX_ROWS,
+             batch_size: int = EVICT_BATCH) -> dict:
+    """
+    Delete expired entries, then, when the table is over its byte or row
+    budget, the least valuable ones until it is back at EVICT_TARGET of
+    it. Every DELETE is capped at `batch_size` rows so locks and WAL stay
+    small and autovacuum keeps up.
+    """
+    expired = 0
+    while True:
+        deleted = execute(_DELETE_EXPIRED, {"limit": batch_size})
+        expired += deleted
+        if deleted < batch_size:
+            break
+
+    totals = fetch_one(_TOTALS)
+    excess_bytes = totals["payload_bytes"] - int(max_bytes * EVICT_TARGET)
+    excess_rows = totals["result_rows"] - int(max_rows * EVICT_TARGET)
+
+    evicted = 0
+    if totals["payload_bytes"] > max_bytes or totals["result_rows"] > max_rows:
+        victims = fetch_df(
+            _EVICTION_CANDIDATES,
+            {
+                "excess_bytes": excess_bytes,
+                "excess_rows": excess_rows,
+                "half_life": EVICT_HALF_LIFE_HOURS
+            }
+        )["cache_key"].tolist()
+
+        for i in range(0, len(victims), batch_size):
+            evicted += execute(
+                "DELETE FROM query_cache WHERE cache_key = ANY(:keys)",
+                {"keys": victims[i:i + batch_size]},
+            )
+
+    _stats["expired"] += expired
+    _stats["evicted"] += evicted
+    _stats["eviction_runs"] += 1
+
+    return {
+        "expired": expired,
+        "evicted": evicted,
+        "payload_bytes": int(totals["payload_bytes"]),
+        "result_rows": int(totals["result_rows"])
+    }
+
+
+def _evict_loop():
+    while True:
+        time.sleep(EVICT_INTERVAL)
+        try:
+            evict_l2()
+        except Exception as e:
+            print(f"L2 eviction failed: {e}")
+
+
+def _ensure_evictor():
+    global _evictor
+
+    if _evictor is not None:
+        return
+
+    with _evict_lock:
+        if _evictor is None:
+            _evictor = threading.Thread(target=_evict_loop, name="l2-evictor", daemon=True)
+            _evictor.start()
+
+
+def eviction_stats() -> dict:
+    """Entries refused as oversized, expired and evicted by this process."""
+    return {k: _stats[k] for k in ("refused", "expired", "evicted", "eviction_runs")}
+
+
+def migrate_result_storage(batch_size: int = 100) -> int:
+    """
+    Re-encode JSONB rows with the configured binary codec.
+    Rows Arrow cannot represent stay as JSONB. Returns rows converted.
+    """
+    converted = 0
+    last_key = ""
+
+    while True:
+        batch = fetch_df(
+            """
+            SELECT cache_key, result_json
+            FROM query_cache
+            WHERE result_codec = 'jsonb'
+              AND result_json IS NOT NULL
+              AND cache_key > :last_key
+            ORDER BY cache_key
+            LIMIT :limit
+            """,
+            {"last_key": last_key, "limit": batch_size},
+        )
+
+        if batch.empty:
+            break
+
+        for key, result_json in zip(batch["cache_key"], batch["result_json"]):
+            codec, payload = encode_result(decode_result(JSONB_CODEC, result_json))
+
+            if codec != JSONB_CODEC:
+                execute(
+                    """
+                    UPDATE query_cache
+                    SET result_blob = :blob, result_codec = :codec, result_json = NULL
+                    WHERE cache_key = :key
+                    """,
+                    {"blob": payload, "codec": codec, "key": key},
+                )
+                converted += 1
+
+        last_key = batch["cache_key"].iloc[-1]
+
+    return converted
+
+
+if __name__ == "__main__":
+    import sys
+    from db.migrations import init
+
+    init()
+
+    if sys.argv[1:] == ["--evict"]:
+        print(evict_l2())
+    else:
+        print(f"{migrate_result_storage()} query_cache rows migrated to binary storage")
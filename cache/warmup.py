@@ -0,0 +1,157 @@
+import asyncio
+import os
+import threading
+import time
+
+from db.db_connection import fetch_df
+from cache.normalize import make_cache_key
+from cache.tier1_cache import estimate_size, set_l1
+from cache.tier2_cache import get_cached_result_by_key_async, save_to_cache_async
+from cache.plan_cache import get_plan
+from cache.dependencies import dependencies_for_sql
+
+WARMUP_ENABLED = os.getenv("WARMUP_ENABLED", "1") == "1"
+WARMUP_TOP_N = int(os.getenv("WARMUP_TOP_N", 50))
+
+# Stop after this many seconds / once this much result data is in L1
+WARMUP_TIME_BUDGET = float(os.getenv("WARMUP_TIME_BUDGET", 30))
+WARMUP_MEMORY_BUDGET = int(os.getenv("WARMUP_MEMORY_BUDGET_MB", 64)) * 1024 * 1024
+
+# Run the SQL again instead of trusting the stored result
+WARMUP_REEXECUTE = os.getenv("WARMUP_REEXECUTE", "0") == "1"
+
+# A hit this many hours ago counts half as much as one now
+WARMUP_HALF_LIFE_HOURS = float(os.getenv("WARMUP_HALF_LIFE_HOURS", 24))
+
+
+_TOP_QUESTIONS = """
+SELECT cache_key, question, sql_query
+FROM query_cache
+ORDER BY (hit_count + 1) * power(
+    0.5,
+    EXTRACT(EPOCH FROM CURRENT_TIMESTAMP - COALESCE(last_hit_at, created_at))
+    / (:half_life * 3600)
+) DESC
+LIMIT :limit
+"""
+
+_status = {"state": "idle"}
+_lock = threading.Lock()
+_thread = None
+
+
+def top_questions(limit: int = WARMUP_TOP_N) -> list:
+    """[(cache_key, question, sql)] by hit count decayed by recency."""
+    df = fetch_df(_TOP_QUESTIONS, {"limit": limit, "half_life": WARMUP_HALF_LIFE_HOURS})
+    return list(df.itertuples(index=False, name=None))
+
+
+async def _load(key: str, question: str, sql: str, reexecute: bool):
+    """(sql, df) for one question, or None when nothing cheap is available."""
+    from llm.query_guard import guard_sql_async
+    from llm.sql_executor import fetch_result_async, is_cacheable
+
+    if not reexecute:
+        cached = await get_cached_result_by_key_async(key)
+        if cached:
+            return cached
+
+    # Never call the LLM during warm-up: only known SQL is run
+    sql = sql or await asyncio.to_thread(get_plan, key)
+    if not sql:
+        return None
+
+    sql, _ = await guard_sql_async(sql)
+    df = await fetch_result_async(sql)
+
+    if not is_cacheable(df):
+        return None
+
+    await save_to_cache_async(question, sql, df, df.attrs["deps"])
+    return sql, df
+
+
+def warm_cache(extra_questions: list = (), limit: int = WARMUP_TOP_N,
+               reexecute: bool = WARMUP_REEXECUTE,
+               time_budget: float = WARMUP_TIME_BUDGET,
+               memory_budget: int = WARMUP_MEMORY_BUDGET) -> dict:
+    """
+    Preload L1 with `extra_questions` (e.g. the app's examples) and the
+    most popular recent questions, within the time and memory budgets.
+    """
+    from llm.sql_executor import run_sync
+
+    start = time.time()
+    status = {"state": "running", "loaded": 0, "skipped": 0, "failed": 0, "bytes": 0}
+    _status.update(status)
+
+    candidates = {make_cache_key(q): (q, None) for q in extra_questions}
+
+    try:
+        for key, question, sql in top_questions(limit):
+            candidates.setdefault(key, (question, sql))
+    except Exception as e:
+        print(f"Warm-up could not read query history: {e}")
+
+    for key, (question, sql) in candidates.items():
+        if time.time() - start > time_budget or status["bytes"] >= memory_budget:
+            status["state"] = "budget exhausted"
+            break
+
+        try:
+            result = run_sync(_load(key, question, sql, reexecute))
+        except Exception as e:
+            print(f"Warm-up failed for {question!r}: {e}")
+            status["failed"] += 1
+            continue
+
+        if result is None:
+            status["skipped"] += 1
+            continue
+
+        sql, df = result
+
+        # Re-executed rows carry the versions taken before their query
+        # ran; reading them now could mark a result of older data fresh
+        deps = df.attrs.get("deps")
+        if deps is None:
+            deps = dependencies_for_sql(sql)
+
+        set_l1(key, sql, df, deps=deps)
+
+        status["loaded"] += 1
+        status["bytes"] += estimate_size(sql, df)
+        _status.update(status)
+
+    if status["state"] == "running":
+        status["state"] = "done"
+
+    status["seconds"] = time.time() - start
+    _status.update(status)
+
+    print(
+        f"Cache warm-up {status['state']}: {status['loaded']} loaded, "
+        f"{status['skipped']} skipped, {status['failed']} failed in {status['seconds']:.1f}s"
+    )
+    return status
+
+
+def start_warmup(extra_questions: list = ()) -> threading.Thread:
+    """Run warm_cache once per process in a daemon thread."""
+    global _thread
+
+    with _lock:
+        if _thread is None and WARMUP_ENABLED:
+            _thread = threading.Thread(
+                target=warm_cache,
+                args=(list(extra_questions),),
+                name="cache-warmup",
+                daemon=True
+            )
+            _thread.start()
+
+    return _thread
+
+
+def warmup_status() -> dict:
+    return dict(_status)
@@ -0,0 +1,149 @@
+import atexit
+import threading
+import time
+from collections import OrderedDict
+
+
+class WriteBehindQueue:
+    """
+    Pending writes keyed by cache key, persisted by a daemon thread in
+    batches of `batch_size` via write_batch(entries). A newer write for
+    the same key replaces the pending one. Entries stay readable through
+    get() until written; when more than `max_bytes` are pending, new
+    writes are dropped instead of growing the backlog.
+    """
+
+    def __init__(self, write_batch, name: str, max_bytes: int, batch_size: int = 100,
+                 interval: float = 0.5, retries: int = 3):
+        self._write_batch = write_batch
+        self._name = name
+        self._max_bytes = max_bytes
+        self._batch_size = batch_size
+        self._interval = interval
+        self._retries = retries
+
+        self._pending = OrderedDict()  # key -> (entry, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._idle = threading.Condition(self._lock)
+        self._writing = 0
+        self._thread = None
+
+        self._stats = {"queued": 0, "written": 0, "dropped": 0, "failed": 0, "retries": 0}
+
+    def put(self, key: str, entry, size: int) -> bool:
+        """Queue a write; False when it was dropped for lack of room."""
+        with self._lock:
+            previous = self._pending.get(key)
+            previous_size = previous[1] if previous is not None else 0
+
+            # A dropped replacement leaves the older pending write in place
+            if self._bytes - previous_size + size > self._max_bytes:
+                self._stats["dropped"] += 1
+                return False
+
+            if previous is not None:
+                del self._pending[key]
+
+            self._pending[key] = (entry, size)
+            self._bytes += size - previous_size
+            self._stats["queued"] += 1
+            full = len(self._pending) >= self._batch_size
+
+        self._ensure_worker()
+        if full:
+            self._wake.set()
+        return True
+
+    def get(self, key: str):
+        """Read-your-writes: the pending entry for `key`, or None."""
+        with self._lock:
+            pending = self._pending.get(key)
+        return pending[0] if pending else None
+
+    def discard(self, predicate) -> int:
+        """Drop pending entries for which predicate(entry) is true."""
+        with self._lock:
+            keys = [k for k, (entry, _) in self._pending.items() if predicate(entry)]
+            for key in keys:
+                self._bytes -= self._pending.pop(key)[1]
+        return len(keys)
+
+    def _take_batch(self) -> list:
+        with self._lock:
+            batch = list(self._pending.items())[:self._batch_size]
+            self._writing += 1 if batch else 0
+        return batch
+
+    def _release(self, batch: list, written: bool):
+        with self._lock:
+            for key, pending in batch:
+                # A newer write for the key may have replaced this one
+                if self._pending.get(key) is pending:
+                    del self._pending[key]
+                    self._bytes -= pending[1]
+
+            self._stats["written" if written else "failed"] += len(batch)
+            self._writing -= 1
+            self._idle.notify_all()
+
+    def _write(self, batch: list):
+        entries = [entry for _, (entry, _) in batch]
+
+        for attempt in range(self._retries + 1):
+            try:
+                self._write_batch(entries)
+                self._release(batch, written=True)
+                return
+            except Exception as e:
+                if attempt == self._retries:
+                    print(f"{self._name}: dropping {len(batch)} writes after {attempt + 1} attempts: {e}")
+                    self._release(batch, written=False)
+                    return
+
+                self._stats["retries"] += 1
+                time.sleep(0.5 * 2 ** attempt)
+
+    def _run(self):
+        while True:
+            self._wake.wait(self._interval)
+            self._wake.clear()
+
+            while True:
+                batch = self._take_batch()
+                if not batch:
+                    break
+                self._write(batch)
+
+    def _ensure_worker(self):
+        if self._thread is not None:
+            return
+
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self._name, daemon=True)
+                self._thread.start()
+                atexit.register(self.flush)
+
+    def flush(self, timeout: float = 10.0) -> bool:
+        """Wait until everything pending is written (or timeout)."""
+        if self._thread is None:
+            return True
+
+        deadline = time.time() + timeout
+        self._wake.set()
+
+        with self._lock:
+            while self._pending or self._writing:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._idle.wait(min(remaining, self._interval))
+                self._wake.set()
+
+        return True
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {**self._stats, "pending": len(self._pending), "pending_bytes": self._bytes}
@@ -0,0 +1,382 @@
+import io
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from db.db_connection import get_engine
+from db.index_advisor import index_ddl, managed_indexes
+from db.schema_introspect import quote_identifier
+
+# Rows parsed and sent per COPY round; bounds memory per file
+LOAD_CHUNK_ROWS = int(os.getenv("LOAD_CHUNK_ROWS", 50_000))
+
+# Files loaded at once, each over its own connection
+LOAD_WORKERS = int(os.getenv("LOAD_WORKERS", 4))
+
+
+def clean_name(name: str) -> str:
+    """Make safe SQL table/column names"""
+    cleaned = re.sub(r"[^a-z0-9_]+", "_", name.lower().strip())
+    cleaned = re.sub(r"_+", "_", cleaned).strip("_")
+
+    if not cleaned:
+        return "unnamed"
+
+    if cleaned[0].isdigit():
+        return f"t_{cleaned}"
+
+    return cleaned
+
+
+def pg_type(dtype) -> str:
+    """Postgres column type for a pandas dtype, as DataFrame.to_sql would pick."""
+    if pd.api.types.is_bool_dtype(dtype):
+        return "BOOLEAN"
+    if pd.api.types.is_integer_dtype(dtype):
+        return "BIGINT"
+    if pd.api.types.is_float_dtype(dtype):
+        return "DOUBLE PRECISION"
+    if pd.api.types.is_datetime64_any_dtype(dtype):
+        return "TIMESTAMP"
+    return "TEXT"
+
+
+def staging_name(table: str) -> str:
+    return f"{table}__staging"
+
+
+def _old_name(table: str) -> str:
+    return f"{table}__old"
+
+
+def create_table_sql(table: str, columns: dict) -> str:
+    cols = ",\n    ".join(
+        f"{quote_identifier(name)} {col_type}" for name, col_type in columns.items()
+    )
+    return f"CREATE TABLE {quote_identifier(table)} (\n    {cols}\n)"
+
+
+def read_chunks(path: str, chunk_rows: int = LOAD_CHUNK_ROWS):
+    """CSV chunks with cleaned column names."""
+    for chunk in pd.read_csv(path, chunksize=chunk_rows):
+        chunk.columns = [clean_name(col) for col in chunk.columns]
+        yield chunk
+
+
+def _coerce(chunk: pd.DataFrame, columns: dict) -> pd.DataFrame:
+    # Later chunks may read an integer column as float (NaNs); write
+    # them as integers so COPY into BIGINT accepts them
+    for name, col_type in columns.items():
+        if col_type == "BIGINT" and not pd.api.types.is_integer_dtype(chunk[name]):
+            chunk[name] = chunk[name].astype("Int64")
+    return chunk
+
+
+def _needed_type(series: pd.Series, current: str) -> str:
+    """Narrowest column type holding this chunk's values."""
+    values = series.dropna()
+
+    if values.empty:
+        return current
+
+    if current == "BOOLEAN" and values.isin([True, False]).all():
+        return current
+
+    needed = pg_type(values.infer_objects().dtype)
+
+    # An integer column with NULLs in this chunk reads as float
+    if needed == "DOUBLE PRECISION" and (values % 1 == 0).all():
+        return "BIGINT"
+
+    return needed
+
+
+def _widen(current: str, needed: str) -> str:
+    if needed == current:
+        return current
+    if {current, needed} <= {"BIGINT", "DOUBLE PRECISION"}:
+        return "DOUBLE PRECISION"
+    return "TEXT"
+
+
+def _fit_chunk(cursor, table: str, chunk: pd.DataFrame, columns: dict) -> pd.DataFrame:
+    """
+    Widen `table`'s columns (BIGINT -> DOUBLE PRECISION -> TEXT) when this
+    chunk holds values the current type can't, then coerce the chunk.
+    Updates `columns` in place.
+    """
+    for name, current in columns.items():
+        # TEXT holds anything; COPY parses timestamps from their text form
+        if current == "TEXT" or current.startswith("TIMESTAMP"):
+            continue
+
+        wider = _widen(current, _needed_type(chunk[name], current))
+
+        if wider != current:
+            col = quote_identifier(name)
+            cursor.execute(
+                f"ALTER TABLE {quote_identifier(table)} ALTER COLUMN {col} TYPE {wider} USING {col}::{wider}"
+            )
+            print(f"`{table}`.{name}: widened {current} -> {wider}")
+            columns[name] = wider
+
+    return _coerce(chunk, columns)
+
+
+def copy_chunk(cursor, table: str, chunk: pd.DataFrame):
+    """COPY one DataFrame chunk in CSV form; empty fields load as NULL."""
+    buf = io.StringIO()
+    chunk.to_csv(buf, index=False, header=False)
+    buf.seek(0)
+
+    cols = ", ".join(quote_identifier(c) for c in chunk.columns)
+    cursor.copy_expert(
+        f"COPY {quote_identifier(table)} ({cols}) FROM STDIN WITH (FORMAT csv)",
+        buf
+    )
+
+
+def swap_in(cursor, table: str):
+    """
+    Replace `table` with its staging copy. Run inside the load's
+    transaction, so readers see either the old or the new table.
+    """
+    old = _old_name(table)
+
+    cursor.execute(f"ALTER TABLE IF EXISTS {quote_identifier(table)} RENAME TO {quote_identifier(old)}")
+    cursor.execute(f"ALTER TABLE {quote_identifier(staging_name(table))} RENAME TO {quote_identifier(table)}")
+    cursor.execute(f"DROP TABLE IF EXISTS {quote_identifier(old)}")
+
+
+def table_columns(cursor, table: str) -> dict:
+    """{column: TYPE} of an existing table, in column order; {} if missing."""
+    cursor.execute(
+        """
+        SELECT column_name, upper(data_type)
+        FROM information_schema.columns
+        WHERE table_schema = 'public' AND table_name = %s
+        ORDER BY ordinal_position
+        """,
+        (table,)
+    )
+    return dict(cursor.fetchall())
+
+
+def _fill_staging(cursor, path: str, table: str) -> int:
+    """Create `table`'s staging table and COPY the whole CSV into it."""
+    staging = staging_name(table)
+    cursor.execute(f"DROP TABLE IF EXISTS {quote_identifier(staging)}")
+
+    columns = None
+    rows = 0
+
+    for chunk in read_chunks(path):
+        if columns is None:
+            # Types start from the first chunk and widen as later chunks need
+            columns = {name: pg_type(dtype) for name, dtype in chunk.dtypes.items()}
+            cursor.execute(create_table_sql(staging, columns))
+
+        copy_chunk(cursor, staging, _fit_chunk(cursor, staging, chunk, columns))
+        rows += len(chunk)
+
+    if columns is None:
+        raise ValueError(f"{path} has no header row")
+
+    return rows
+
+
+def _build_indexes(cursor, table: str) -> list:
+    """
+    Rebuild the advisor's indexes for `table` on its staging copy, under
+    a temporary name while the live table still holds the real one.
+    """
+    present = table_columns(cursor, staging_name(table))
+    built = []
+
+    for name, columns in managed_indexes(cursor, table):
+        if all(c in present for c in columns):
+            cursor.execute(index_ddl(staging_name(table), columns, f"{name}__new"))
+            built.append(name)
+
+    return built
+
+
+def _rename_indexes(cursor, names: list):
+    # The old table and its indexes are gone after the swap
+    for name in names:
+        cursor.execute(f"ALTER INDEX {quote_identifier(name + '__new')} RENAME TO {quote_identifier(name)}")
+
+
+def _analyze(cursor, table: str):
+    # Fresh planner estimates for introspection and the query guard
+    cursor.execute(f"ANALYZE {quote_identifier(table)}")
+
+
+def _run_load(path: str, table: str, mode: str, body, before_commit=None) -> dict:
+    """
+    Run body(cursor) -> rows in one transaction on a dedicated connection.
+    before_commit(cursor, stats) can write bookkeeping in the same
+    transaction (e.g. the ingestion manifest).
+    """
+    start = time.time()
+    conn = get_engine().raw_connection()
+
+    try:
+        cursor = conn.cursor()
+        rows = body(cursor)
+
+        seconds = time.time() - start
+        stats = {
+            "file": os.path.basename(path),
+            "table": table,
+            "mode": mode,
+            "rows": rows,
+            "seconds": seconds,
+            "rows_per_sec": rows / seconds if seconds else 0.0
+        }
+
+        if before_commit is not None:
+            before_commit(cursor, stats)
+
+        conn.commit()
+
+    except Exception:
+        conn.rollback()
+        raise
+
+    finally:
+        conn.close()
+
+    return stats
+
+
+def load_csv(path: str, table: str, before_commit=None) -> dict:
+    """
+    Stream one CSV into `table` through COPY FROM STDIN via a staging
+    table, swapped in atomically. Returns load stats.
+    """
+    def body(cursor):
+        rows = _fill_staging(cursor, path, table)
+        indexes = _build_indexes(cursor, table)
+        swap_in(cursor, table)
+        _rename_indexes(cursor, indexes)
+        _analyze(cursor, table)
+        return rows
+
+    return _run_load(path, table, "replace", body, before_commit)
+
+
+def append_csv(path: str, table: str, offset: int, before_commit=None) -> dict:
+    """
+    COPY only the rows after byte `offset` (a line boundary) into the
+    existing table, for files that grew since the last load.
+    """
+    def body(cursor):
+        columns = table_columns(cursor, table)
+        header = [clean_name(c) for c in pd.read_csv(path, nrows=0).columns]
+
+        if list(columns) != header:
+            raise ValueError(f"{path} columns no longer match table `{table}`")
+
+        rows = 0
+
+        with open(path, "rb") as f:
+            f.seek(offset)
+
+            for chunk in pd.read_csv(f, header=None, names=header, chunksize=LOAD_CHUNK_ROWS):
+                copy_chunk(cursor, table, _fit_chunk(cursor, table, chunk, columns))
+                rows += len(chunk)
+
+        _analyze(cursor, table)
+        return rows
+
+    return _run_load(path, table, "append", body, before_commit)
+
+
+def upsert_csv(path: str, table: str, keys: list, before_commit=None) -> dict:
+    """
+    Stage the CSV, then INSERT ... ON CONFLICT (keys) DO UPDATE into the
+    live table. Rows missing from the file are kept.
+    """
+    def body(cursor):
+        rows = _fill_staging(cursor, path, table)
+
+        if not table_columns(cursor, table):
+            indexes = _build_indexes(cursor, table)
+            swap_in(cursor, table)
+            _rename_indexes(cursor, indexes)
+        else:
+            staging = staging_name(table)
+            columns = list(table_columns(cursor, staging))
+            cols = ", ".join(quote_identifier(c) for c in columns)
+            key_cols = ", ".join(quote_identifier(k) for k in keys)
+            updates = ", ".join(
+                f"{quote_identifier(c)} = EXCLUDED.{quote_identifier(c)}"
+                for c in columns if c not in keys
+            )
+
+            # ON CONFLICT needs a unique index on the key columns
+            cursor.execute(
+                f"CREATE UNIQUE INDEX IF NOT EXISTS {quote_identifier(table + '__upsert_key')} "
+                f"ON {quote_identifier(table)} ({key_cols})"
+            )
+            cursor.execute(
+                f"INSERT INTO {quote_identifier(table)} ({cols}) "
+                f"SELECT {cols} FROM {quote_identifier(staging)} "
+                f"ON CONFLICT ({key_cols}) "
+                + (f"DO UPDATE SET {updates}" if updates else "DO NOTHING")
+            )
+            cursor.execute(f"DROP TABLE {quote_identifier(staging)}")
+
+        _analyze(cursor, table)
+        return rows
+
+    return _run_load(path, table, "upsert", body, before_commit)
+
+
+def run_loads(jobs: dict, workers: int = LOAD_WORKERS) -> tuple:
+    """
+    Run {path: fn() -> stats} in parallel, one connection per file.
+    Returns (stats of each loaded file, {path: error} of failed ones);
+    a failed file leaves its table untouched.
+    """
+    start = time.time()
+    results, failed = [], {}
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = {pool.submit(fn): path for path, fn in jobs.items()}
+
+        for future, path in futures.items():
+            try:
+                stats = future.result()
+            except Exception as e:
+                print(f"Failed to load {os.path.basename(path)}: {e}")
+                failed[path] = str(e)
+                continue
+
+            print(
+                f"{stats['file']} -> `{stats['table']}` ({stats['mode']}): {stats['rows']} rows "
+                f"in {stats['seconds']:.2f}s ({stats['rows_per_sec']:.0f} rows/sec)"
+            )
+            results.append(stats)
+
+    total_rows = sum(r["rows"] for r in results)
+    elapsed = time.time() - start
+
+    print(
+        f"Loaded {total_rows} rows from {len(results)} files in {elapsed:.2f}s "
+        f"({total_rows / elapsed if elapsed else 0:.0f} rows/sec)"
+    )
+
+    return results, failed
+
+
+def load_files(files: dict, workers: int = LOAD_WORKERS) -> tuple:
+    """Full reload of {path: table} in parallel; see run_loads."""
+    return run_loads(
+        {path: (lambda p=path, t=table: load_csv(p, t)) for path, table in files.items()},
+        workers
+    )
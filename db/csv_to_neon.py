@@ -1,38 +1,40 @@
+import sys
 import os
-import re
-import pandas as pd
-from sqlalchemy import create_engine
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+
 from dotenv import load_dotenv
 
-load_dotenv()
+from cache.invalidation import invalidate_tables
+from db.bulk_loader import LOAD_WORKERS, clean_name
+from db.ingest_manifest import ingest_files, parse_upsert_keys
+from db.migrations import init
 
-NEON_DB_URL = os.getenv("NEON_DB_URL") 
+load_dotenv()
 
-if not NEON_DB_URL:
-    raise ValueError("Please set NEON_DB_URL environment variable")
+NEON_DB_URL = os.getenv("NEON_DB_URL")
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
 DATA_FOLDER = os.path.join(BASE_DIR, "data_dump")
 
-engine = create_engine(NEON_DB_URL)
-
+# Tables loaded by key-based upsert instead of replace, e.g.
+# "customers:customer_id;products:product_id"
+UPSERT_KEYS = parse_upsert_keys(os.getenv("INGEST_UPSERT_KEYS", ""))
 
-def clean_name(name: str) -> str:
-    """Make safe SQL table/column names"""
-    cleaned = re.sub(r"[^a-z0-9_]+", "_", name.lower().strip())
-    cleaned = re.sub(r"_+", "_", cleaned).strip("_")
 
-    if not cleaned:
-        return "unnamed"
+def upload_all_csv(full: bool = False, upsert_keys: dict = None,
+                   workers: int = LOAD_WORKERS):
+    """
+    Load data_dump/*.csv, skipping files unchanged since the last run
+    (see db/ingest_manifest.py). Returns the tables that changed.
+    """
 
-    if cleaned[0].isdigit():
-        return f"t_{cleaned}"
+    if not NEON_DB_URL:
+        raise ValueError("Please set NEON_DB_URL environment variable")
 
-    return cleaned
-
-
-def upload_all_csv():
+    init()
 
     if not os.path.exists(DATA_FOLDER):
         raise FileNotFoundError(f"Folder not found: {DATA_FOLDER}")
@@ -44,31 +46,46 @@ def upload_all_csv():
 
     print(f"Found {len(files)} CSV files\n")
 
-    for file in files:
+    # Imported here: the loader only needs the schema check, not the LLM stack
+    from llm.text_to_sql import check_schema
 
-        path = os.path.join(DATA_FOLDER, file)
+    # Fingerprints before the load, so a changed table shape is noticed after it
+    check_schema(force=True)
 
-        table_name = clean_name(os.path.splitext(file)[0])
+    # COPY-streamed, parallel; replaced tables are swapped in atomically
+    outcome = ingest_files(
+        {
+            os.path.join(DATA_FOLDER, file): clean_name(os.path.splitext(file)[0])
+            for file in files
+        },
+        upsert_keys=UPSERT_KEYS if upsert_keys is None else upsert_keys,
+        full=full,
+        workers=workers
+    )
 
-        print(f"Uploading {file} table `{table_name}`")
+    changed = outcome["changed"]
 
-        df = pd.read_csv(path)
+    # Only cached results that read a changed table go stale
+    invalidate_tables(changed)
 
-        # Clean column names
-        df.columns = [clean_name(col) for col in df.columns]
+    # A reload that added, dropped or retyped columns also drops the
+    # plans written against the old shape
+    check_schema(force=True)
 
-        df.to_sql(
-            table_name,
-            engine,
-            if_exists="replace",   # change to "append" if needed
-            index=False,
-            method="multi"
+    if outcome["failed"]:
+        raise RuntimeError(
+            f"{len(outcome['failed'])} CSV files failed to load: {', '.join(outcome['failed'])}"
         )
 
-        print(f"{len(df)} rows uploaded")
-
+    print(f"Changed tables: {', '.join(changed) or 'none'}")
     print("All CSV files successfully uploaded to Neon!")
 
+    return changed
+
 
 if __name__ == "__main__":
-    upload_all_csv()
+    parser = argparse.ArgumentParser(description="Load data_dump/*.csv into Postgres.")
+    parser.add_argument("--full", action="store_true", help="Reload every file, ignoring the manifest.")
+    args = parser.parse_args()
+
+    upload_all_csv(full=args.full)
@@ -1,6 +1,9 @@
+import asyncio
 import os
+import threading
+import weakref
 import pandas as pd
-from sqlalchemy import create_engine, text
+from sqlalchemy import create_engine, make_url, text
 from dotenv import load_dotenv
 
 
@@ -8,37 +11,210 @@ load_dotenv()
 
 NEON_DB_URL = os.getenv("NEON_DB_URL")
 
-if not NEON_DB_URL:
-    raise ValueError("NEON_DB_URL not found in environment")
+# Created on first use, so importing this module never touches the database
+_engine = None
+_engine_lock = threading.Lock()
 
 
-engine = create_engine(
-    NEON_DB_URL,
-    pool_pre_ping=True,   
-    pool_size=5,
-    max_overflow=10
-)
+def _db_url() -> str:
+    if not NEON_DB_URL:
+        raise ValueError("NEON_DB_URL not found in environment")
+    return NEON_DB_URL
+
+
+def get_engine():
+    global _engine
+
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = create_engine(
+                    _db_url(),
+                    pool_pre_ping=True,
+                    pool_size=5,
+                    max_overflow=10
+                )
+
+    return _engine
+
+
+# Advisory locks are held for a whole LLM call, so they get their own
+# unpooled autocommit connections instead of pinning the query pool
+# (and sitting idle in transaction) while they wait.
+_lock_engine = None
+_async_lock_engine = None
+
+
+def get_lock_engine():
+    global _lock_engine
+    from sqlalchemy.pool import NullPool
+
+    if _lock_engine is None:
+        with _engine_lock:
+            if _lock_engine is None:
+                _lock_engine = create_engine(
+                    _db_url(),
+                    poolclass=NullPool,
+                    isolation_level="AUTOCOMMIT"
+                )
+
+    return _lock_engine
+
+
+def __getattr__(name):
+    # `from db.db_connection import engine` still works, lazily
+    if name == "engine":
+        return get_engine()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 
 def fetch_df(sql: str, params: dict = None):
 
-    with engine.connect() as conn:
+    with get_engine().connect() as conn:
         df = pd.read_sql(text(sql), conn, params=params)
 
     return df
 
-def execute(sql: str, params: dict = None):
+def execute(sql: str, params: dict = None) -> int:
+
+    with get_engine().begin() as conn:
+        result = conn.execute(text(sql), params or {})
 
-    with engine.begin() as conn:
-        conn.execute(text(sql), params or {})
+    return result.rowcount
 
 
 def fetch_scalar(sql: str, params: dict = None):
 
-    with engine.connect() as conn:
+    with get_engine().connect() as conn:
         result = conn.execute(text(sql), params or {}).scalar()
 
     return result
 
+def _statement_timeout_sql(timeout_ms: int) -> str:
+    # SET LOCAL only lasts for the current transaction, so pooled
+    # connections never keep another request's timeout
+    return f"SET LOCAL statement_timeout = {int(timeout_ms)}"
+
+
+def fetch_one(sql: str, params: dict = None):
+    """First row as a mapping (column -> value), or None."""
+
+    with get_engine().connect() as conn:
+        row = conn.execute(text(sql), params or {}).mappings().first()
+
+    return row
+
+def _async_url(url: str):
+    """Same database through asyncpg, which spells sslmode as ssl."""
+    url = make_url(url).set(drivername="postgresql+asyncpg")
+    sslmode = url.query.get("sslmode")
+
+    url = url.difference_update_query(["sslmode", "channel_binding"])
+
+    if sslmode:
+        url = url.update_query_dict({"ssl": sslmode})
+
+    return url
+
+
+# asyncpg connections belong to the event loop that opened them,
+# so each running loop gets its own async engine. Weak keys: a closed,
+# collected loop doesn't keep its engine alive; dispose_async_engine()
+# closes the connections before the loop goes.
+_async_engines = weakref.WeakKeyDictionary()
+_async_engines_lock = threading.Lock()
+
+
+def get_async_engine():
+    from sqlalchemy.ext.asyncio import create_async_engine
+
+    loop = asyncio.get_running_loop()
+
+    with _async_engines_lock:
+        async_engine = _async_engines.get(loop)
+
+        if async_engine is None:
+            async_engine = create_async_engine(
+                _async_url(_db_url()),
+                pool_pre_ping=True,
+                pool_size=5,
+                max_overflow=10
+            )
+            _async_engines[loop] = async_engine
+
+    return async_engine
+
+
+async def dispose_async_engine():
+    """Close the running loop's pool; call before a short-lived loop (asyncio.run) ends."""
+    loop = asyncio.get_running_loop()
+
+    with _async_engines_lock:
+        async_engine = _async_engines.pop(loop, None)
+
+    if async_engine is not None:
+        await async_engine.dispose()
+
+
+def get_async_lock_engine():
+    """Unpooled, so one engine serves every event loop."""
+    global _async_lock_engine
+    from sqlalchemy.ext.asyncio import create_async_engine
+    from sqlalchemy.pool import NullPool
+
+    with _async_engines_lock:
+        if _async_lock_engine is None:
+            _async_lock_engine = create_async_engine(
+                _async_url(_db_url()),
+                poolclass=NullPool,
+                isolation_level="AUTOCOMMIT"
+            )
+
+    return _async_lock_engine
+
+
+async def fetch_df_async(sql: str, params: dict = None):
+
+    async with get_async_engine().connect() as conn:
+        df = await conn.run_sync(
+            lambda sync_conn: pd.read_sql(text(sql), sync_conn, params=params)
+        )
+
+    return df
+
+async def iter_df_chunks_async(sql: str, params: dict = None, chunk_rows: int = 5000,
+                               statement_timeout_ms: int = None):
+    """Async server-side cursor; always yields at least one (maybe empty) chunk."""
+
+    async with get_async_engine().connect() as conn:
+        if statement_timeout_ms:
+            await conn.execute(text(_statement_timeout_sql(statement_timeout_ms)))
+
+        result = await conn.stream(text(sql), params or {})
+        columns = list(result.keys())
+        empty = True
+
+        async for rows in result.partitions(chunk_rows):
+            empty = False
+            yield pd.DataFrame.from_records(rows, columns=columns, coerce_float=True)
+
+        if empty:
+            yield pd.DataFrame(columns=columns)
+
+async def execute_async(sql: str, params: dict = None):
+
+    async with get_async_engine().begin() as conn:
+        await conn.execute(text(sql), params or {})
+
+
+async def fetch_one_async(sql: str, params: dict = None):
+
+    async with get_async_engine().connect() as conn:
+        result = await conn.execute(text(sql), params or {})
+        row = result.mappings().first()
+
+    return row
+
 def test_connection():
 
     try:
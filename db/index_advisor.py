@@ -0,0 +1,285 @@
+import os
+import re
+import sys
+from collections import defaultdict
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import text
+
+from db.db_connection import execute, fetch_df, get_engine
+from db.schema_introspect import introspect_schema, quote_identifier
+
+# A column needs this many logged queries filtering/joining on it
+INDEX_MIN_QUERIES = int(os.getenv("INDEX_MIN_QUERIES", 2))
+
+# Optional size gate: skip tables under this many rows. Off by default,
+# since the query-count / total_ms ranking already puts indexes that
+# don't pay off last
+INDEX_MIN_ROWS = int(os.getenv("INDEX_MIN_ROWS", 0))
+
+_IDENT = r'(?:"[^"]+"|\w+)'
+_TABLE_ALIAS = re.compile(
+    rf"\b(?:FROM|JOIN)\s+({_IDENT}(?:\s*\.\s*{_IDENT})?)(?:\s+(?:AS\s+)?({_IDENT}))?",
+    re.IGNORECASE
+)
+_COMPARISON = re.compile(
+    rf"(?:({_IDENT})\s*\.\s*)?({_IDENT})\s*(?:=|<>|!=|<=|>=|<|>|\bIN\b|\bBETWEEN\b)",
+    re.IGNORECASE
+)
+_JOIN_ON = re.compile(
+    rf"\bON\s+({_IDENT})\s*\.\s*({_IDENT})\s*=\s*({_IDENT})\s*\.\s*({_IDENT})",
+    re.IGNORECASE
+)
+_STRING = re.compile(r"'(?:[^']|'')*'")
+
+_NOT_ALIASES = {
+    "where", "join", "inner", "left", "right", "full", "cross", "on", "group",
+    "order", "limit", "offset", "having", "union", "natural", "using", "window"
+}
+
+
+def ensure_recommendation_table():
+    execute("""
+    CREATE TABLE IF NOT EXISTS index_recommendations (
+        table_name TEXT NOT NULL,
+        columns TEXT[] NOT NULL,
+        index_name TEXT NOT NULL,
+        kind TEXT NOT NULL,
+        query_count INTEGER NOT NULL,
+        total_ms DOUBLE PRECISION NOT NULL DEFAULT 0,
+        created BOOLEAN NOT NULL DEFAULT FALSE,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (table_name, columns)
+    );
+    """)
+
+
+
+def _name(identifier: str) -> str:
+    identifier = identifier.split(".")[-1].strip()
+    if identifier.startswith('"'):
+        return identifier[1:-1]
+    return identifier.lower()
+
+
+def index_name(table: str, columns: list) -> str:
+    # Leave room for suffixes within the 63-byte identifier limit
+    return f"idx_{table}_{'_'.join(columns)}"[:50]
+
+
+def index_ddl(table: str, columns: list, name: str = None, concurrently: bool = False) -> str:
+    cols = ", ".join(quote_identifier(c) for c in columns)
+    return (
+        f"CREATE INDEX {'CONCURRENTLY ' if concurrently else ''}IF NOT EXISTS "
+        f"{quote_identifier(name or index_name(table, columns))} "
+        f"ON {quote_identifier(table)} USING btree ({cols})"
+    )
+
+
+def extract_columns(sql: str, schema) -> dict:
+    """
+    {(table, column): kind} for columns compared in WHERE / ON clauses,
+    kind being "join" or "predicate". Aliases are resolved through the
+    FROM / JOIN list; unqualified columns are attributed when exactly
+    one referenced table has them.
+    """
+    sql = _STRING.sub("''", sql)
+
+    aliases = {}
+    for table, alias in _TABLE_ALIAS.findall(sql):
+        table = _name(table)
+        if table not in schema.tables:
+            continue
+        aliases[table] = table
+        if alias and _name(alias) not in _NOT_ALIASES:
+            aliases[_name(alias)] = table
+
+    referenced = set(aliases.values())
+    columns_of = {
+        t: {c.name for c in schema.tables[t].columns} for t in referenced
+    }
+
+    def resolve(qualifier, column):
+        column = _name(column)
+        if qualifier:
+            table = aliases.get(_name(qualifier))
+            return (table, column) if table and column in columns_of[table] else None
+
+        owners = [t for t in referenced if column in columns_of[t]]
+        return (owners[0], column) if len(owners) == 1 else None
+
+    found = {}
+
+    for qualifier, column in _COMPARISON.findall(sql):
+        ref = resolve(qualifier, column)
+        if ref:
+            found.setdefault(ref, "predicate")
+
+    for q1, c1, q2, c2 in _JOIN_ON.findall(sql):
+        for ref in (resolve(q1, c1), resolve(q2, c2)):
+            if ref:
+                found[ref] = "join"
+
+    return found
+
+
+def _indexed_leading_columns(schema) -> set:
+    """(table, column) pairs already leading some index."""
+    leading = set()
+
+    for table in schema.tables.values():
+        for index in table.indexes:
+            match = re.search(r"\(\s*\"?(\w+)\"?", index.definition)
+            if match:
+                leading.add((table.name, match.group(1)))
+
+    return leading
+
+
+def recommend_indexes(min_queries: int = INDEX_MIN_QUERIES, min_rows: int = INDEX_MIN_ROWS) -> list:
+    """
+    Mine the SQL logged in query_cache and rank single-column B-tree
+    indexes by the execution time of the queries that would use them.
+    """
+    schema = introspect_schema()
+    log = fetch_df("SELECT sql_query, execution_ms FROM query_cache")
+    indexed = _indexed_leading_columns(schema)
+
+    stats = defaultdict(lambda: {"queries": 0, "total_ms": 0.0, "kind": "predicate"})
+
+    for sql, ms in zip(log["sql_query"], log["execution_ms"]):
+        for ref, kind in extract_columns(sql, schema).items():
+            entry = stats[ref]
+            entry["queries"] += 1
+            entry["total_ms"] += float(ms) if ms is not None and ms == ms else 0.0  # NaN-safe
+            if kind == "join":
+                entry["kind"] = "join"
+
+    recommendations = []
+
+    for (table, column), entry in stats.items():
+        rows = schema.tables[table].row_count
+
+        if entry["queries"] < min_queries or (table, column) in indexed:
+            continue
+        if rows is not None and rows < min_rows:
+            continue
+
+        recommendations.append({
+            "table": table,
+            "columns": [column],
+            "index_name": index_name(table, [column]),
+            "kind": entry["kind"],
+            "queries": entry["queries"],
+            "total_ms": entry["total_ms"],
+            "ddl": index_ddl(table, [column])
+        })
+
+    return sorted(recommendations, key=lambda r: (-r["total_ms"], -r["queries"]))
+
+
+def save_recommendations(recommendations: list):
+    for r in recommendations:
+        execute(
+            """
+            INSERT INTO index_recommendations
+            (table_name, columns, index_name, kind, query_count, total_ms)
+            VALUES (:table, :columns, :name, :kind, :queries, :total_ms)
+            ON CONFLICT (table_name, columns) DO UPDATE SET
+                kind = EXCLUDED.kind,
+                query_count = EXCLUDED.query_count,
+                total_ms = EXCLUDED.total_ms,
+                updated_at = CURRENT_TIMESTAMP
+            """,
+            {
+                "table": r["table"],
+                "columns": r["columns"],
+                "name": r["index_name"],
+                "kind": r["kind"],
+                "queries": r["queries"],
+                "total_ms": r["total_ms"]
+            }
+        )
+
+
+_INVALID_INDEX = """
+SELECT 1
+FROM pg_index i
+JOIN pg_class c ON c.oid = i.indexrelid
+JOIN pg_namespace n ON n.oid = c.relnamespace
+WHERE n.nspname = 'public'
+  AND c.relname = :name
+  AND NOT i.indisvalid
+"""
+
+
+def _drop_if_invalid(conn, name: str):
+    # A failed CREATE INDEX CONCURRENTLY leaves an INVALID index behind,
+    # which IF NOT EXISTS would then skip forever
+    if conn.execute(text(_INVALID_INDEX), {"name": name}).first():
+        conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {quote_identifier(name)}"))
+
+
+def create_indexes(recommendations: list) -> list:
+    """
+    CREATE INDEX CONCURRENTLY for each recommendation (no write lock on
+    the table) and remember it, so reloads rebuild it. A failed build is
+    dropped and skipped. Returns the names created.
+    """
+    save_recommendations(recommendations)
+    created = []
+
+    # CONCURRENTLY can't run inside a transaction block
+    with get_engine().connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        for r in recommendations:
+            name = r["index_name"]
+
+            try:
+                _drop_if_invalid(conn, name)
+                conn.execute(text(index_ddl(r["table"], r["columns"], name, concurrently=True)))
+            except Exception as e:
+                print(f"Could not create {name}: {e}")
+                _drop_if_invalid(conn, name)
+                continue
+
+            # Recorded right away, so a later failure can't lose it
+            conn.execute(
+                text("UPDATE index_recommendations SET created = TRUE WHERE index_name = :name"),
+                {"name": name}
+            )
+            created.append(name)
+
+    return created
+
+
+def managed_indexes(cursor, table: str) -> list:
+    """[(index_name, columns)] created by the advisor for `table` (DB-API cursor)."""
+    cursor.execute(
+        "SELECT index_name, columns FROM index_recommendations WHERE table_name = %s AND created",
+        (table,)
+    )
+    return cursor.fetchall()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Recommend B-tree indexes from the query log.")
+    parser.add_argument("--create", action="store_true", help="Create the recommended indexes.")
+    args = parser.parse_args()
+
+    from db.migrations import init
+    init()
+
+    recommendations = recommend_indexes()
+
+    if not recommendations:
+        print("No index recommendations")
+
+    for r in recommendations:
+        print(f"{r['ddl']};  -- {r['kind']}, {r['queries']} queries, {r['total_ms']:.0f} ms")
+
+    if args.create and recommendations:
+        print(f"Created: {', '.join(create_indexes(recommendations))}")
+    elif recommendations:
+        save_recommendations(recommendations)
@@ -0,0 +1,192 @@
+import hashlib
+import os
+
+from db.db_connection import execute, fetch_df
+from db.bulk_loader import LOAD_WORKERS, append_csv, load_csv, run_loads, upsert_csv
+
+CHECKSUM_BLOCK = 1024 * 1024
+
+
+def ensure_manifest_table():
+    execute("""
+    CREATE TABLE IF NOT EXISTS ingestion_manifest (
+        file_name TEXT PRIMARY KEY,
+        table_name TEXT NOT NULL,
+        checksum TEXT NOT NULL,
+        size_bytes BIGINT NOT NULL,
+        mtime DOUBLE PRECISION NOT NULL,
+        row_count BIGINT NOT NULL,
+        load_mode TEXT NOT NULL,
+        loaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    """)
+
+
+
+_UPSERT_MANIFEST = """
+INSERT INTO ingestion_manifest
+(file_name, table_name, checksum, size_bytes, mtime, row_count, load_mode, loaded_at)
+VALUES (%s, %s, %s, %s, %s, %s, %s, CURRENT_TIMESTAMP)
+ON CONFLICT (file_name) DO UPDATE SET
+    table_name = EXCLUDED.table_name,
+    checksum = EXCLUDED.checksum,
+    size_bytes = EXCLUDED.size_bytes,
+    mtime = EXCLUDED.mtime,
+    row_count = EXCLUDED.row_count,
+    load_mode = EXCLUDED.load_mode,
+    loaded_at = EXCLUDED.loaded_at
+"""
+
+
+def file_checksums(path: str, prefix_size: int = None):
+    """
+    (sha256 of the file, sha256 of its first prefix_size bytes) in one
+    pass; the prefix hash is None when not requested or out of range.
+    """
+    full = hashlib.sha256()
+    prefix = None
+    read = 0
+
+    with open(path, "rb") as f:
+        while True:
+            block = f.read(CHECKSUM_BLOCK)
+            if not block:
+                break
+
+            if prefix_size is not None and read < prefix_size <= read + len(block):
+                head = full.copy()
+                head.update(block[:prefix_size - read])
+                prefix = head.hexdigest()
+
+            full.update(block)
+            read += len(block)
+
+    if prefix_size == 0:
+        prefix = hashlib.sha256().hexdigest()
+
+    return full.hexdigest(), prefix
+
+
+def _ends_with_newline(path: str, offset: int) -> bool:
+    with open(path, "rb") as f:
+        f.seek(offset - 1)
+        return f.read(1) == b"\n"
+
+
+def get_manifest() -> dict:
+    df = fetch_df("SELECT * FROM ingestion_manifest")
+    return {row["file_name"]: row for row in df.to_dict(orient="records")}
+
+
+def plan_file(path: str, table: str, record: dict, upsert_keys: list = None):
+    """
+    Decide how to bring `table` up to date with `path`.
+    Returns (action, checksum, offset) with action one of
+    skip / touch / replace / append / upsert.
+    """
+    stat = os.stat(path)
+
+    if record is not None and record["table_name"] == table:
+        if stat.st_size == record["size_bytes"] and stat.st_mtime == record["mtime"]:
+            return "skip", record["checksum"], None
+
+        grew = stat.st_size > record["size_bytes"]
+        checksum, prefix = file_checksums(path, record["size_bytes"] if grew else None)
+
+        if checksum == record["checksum"]:
+            # Touched but identical
+            return "touch", checksum, None
+
+        if grew and prefix == record["checksum"] and _ends_with_newline(path, record["size_bytes"]):
+            return "append", checksum, record["size_bytes"]
+    else:
+        checksum, _ = file_checksums(path)
+
+    if upsert_keys:
+        return "upsert", checksum, None
+
+    return "replace", checksum, None
+
+
+def _manifest_writer(path: str, table: str, checksum: str, base_rows: int = 0):
+    """before_commit hook: record the file in the same transaction as its load."""
+    stat = os.stat(path)
+
+    def write(cursor, stats):
+        rows = base_rows + stats["rows"] if stats["mode"] == "append" else stats["rows"]
+        cursor.execute(
+            _UPSERT_MANIFEST,
+            (os.path.basename(path), table, checksum, stat.st_size, stat.st_mtime, rows, stats["mode"])
+        )
+
+    return write
+
+
+def _touch(path: str):
+    execute(
+        "UPDATE ingestion_manifest SET mtime = :mtime WHERE file_name = :file",
+        {"mtime": os.stat(path).st_mtime, "file": os.path.basename(path)}
+    )
+
+
+def ingest_files(files: dict, upsert_keys: dict = None, full: bool = False,
+                 workers: int = LOAD_WORKERS) -> dict:
+    """
+    Bring {path: table} up to date, loading only what changed:
+    unchanged files are skipped, files that only grew are appended,
+    tables in `upsert_keys` ({table: [key columns]}) are upserted, the
+    rest replaced. `full` reloads everything.
+
+    Returns {"changed": [tables], "skipped": [tables], "results": [stats],
+    "failed": {path: error}}.
+    """
+    upsert_keys = upsert_keys or {}
+    manifest = {} if full else get_manifest()
+
+    jobs, skipped = {}, []
+
+    for path, table in files.items():
+        record = manifest.get(os.path.basename(path))
+        keys = upsert_keys.get(table)
+
+        action, checksum, offset = plan_file(path, table, record, keys)
+
+        if action in ("skip", "touch"):
+            if action == "touch":
+                _touch(path)
+            print(f"{os.path.basename(path)} unchanged - skipped")
+            skipped.append(table)
+            continue
+
+        if action == "append":
+            hook = _manifest_writer(path, table, checksum, record["row_count"])
+            jobs[path] = lambda p=path, t=table, o=offset, h=hook: append_csv(p, t, o, h)
+
+        elif action == "upsert":
+            hook = _manifest_writer(path, table, checksum)
+            jobs[path] = lambda p=path, t=table, k=keys, h=hook: upsert_csv(p, t, k, h)
+
+        else:
+            hook = _manifest_writer(path, table, checksum)
+            jobs[path] = lambda p=path, t=table, h=hook: load_csv(p, t, h)
+
+    results, failed = run_loads(jobs, workers) if jobs else ([], {})
+
+    return {
+        "changed": sorted({r["table"] for r in results}),
+        "skipped": sorted(skipped),
+        "results": results,
+        "failed": failed
+    }
+
+
+def parse_upsert_keys(spec: str) -> dict:
+    """'customers:customer_id;orders:order_id,line' -> {table: [columns]}"""
+    keys = {}
+
+    for part in (spec or "").split(";"):
+        if ":" in part:
+            table, cols = part.split(":", 1)
+            keys[table.strip()] = [c.strip() for c in cols.split(",") if c.strip()]
+
+    return keys
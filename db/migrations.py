@@ -0,0 +1,46 @@
+import os
+import sys
+import threading
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_done = False
+_lock = threading.Lock()
+
+
+def init(force: bool = False):
+    """
+    Create or upgrade every table the caches and loaders use.
+
+    Importing a module never runs DDL, so entry points (the app, CLIs,
+    benchmarks, workers) call this once at startup. Idempotent; later
+    calls in the same process return immediately unless `force`.
+    """
+    global _done
+
+    with _lock:
+        if _done and not force:
+            return
+
+        from cache.dependencies import ensure_version_table
+        from cache.tier2_cache import ensure_cache_table
+        from cache.plan_cache import ensure_plan_table
+        from cache.semantic_cache import ensure_semantic_table
+        from db.ingest_manifest import ensure_manifest_table
+        from db.index_advisor import ensure_recommendation_table
+
+        for ensure in (
+            ensure_version_table,
+            ensure_cache_table,
+            ensure_plan_table,
+            ensure_semantic_table,
+            ensure_manifest_table,
+            ensure_recommendation_table
+        ):
+            ensure()
+
+        _done = True
+
+
+if __name__ == "__main__":
+    init(force=True)
+    print("Cache and ingestion tables are up to date")
@@ -1,57 +1,281 @@
+from dataclasses import dataclass, field
+
 from db.db_connection import fetch_df
 
+# The app's own bookkeeping tables: never shown to the LLM, sampled for
+# retrieval or fingerprinted. Bulk-load staging / swap tables neither.
+INTERNAL_TABLES = frozenset({
+    "query_cache",
+    "sql_plan_cache",
+    "semantic_cache",
+    "table_versions",
+    "ingestion_manifest",
+    "index_recommendations",
+})
+INTERNAL_SUFFIXES = ("__staging", "__old")
+
+
+def is_internal_table(name: str) -> bool:
+    return name in INTERNAL_TABLES or name.endswith(INTERNAL_SUFFIXES)
+
+
+@dataclass
+class Column:
+    name: str
+    data_type: str
+    nullable: bool = True
+
+
+@dataclass
+class ForeignKey:
+    columns: list
+    ref_table: str
+    ref_columns: list
+
+
+@dataclass
+class Index:
+    name: str
+    definition: str
+    unique: bool = False
+    primary: bool = False
+
+
+@dataclass
+class Table:
+    name: str
+    columns: list = field(default_factory=list)
+    primary_key: list = field(default_factory=list)
+    foreign_keys: list = field(default_factory=list)
+    indexes: list = field(default_factory=list)
+    row_count: int = None        # None when unknown (never analyzed)
+    row_count_exact: bool = False
+
+
+@dataclass
+class DatabaseSchema:
+    tables: dict = field(default_factory=dict)  # name -> Table
+
+    def table_names(self) -> list:
+        return sorted(self.tables)
+
 
 def quote_identifier(identifier: str) -> str:
     """Safely quote PostgreSQL identifiers such as table names."""
     return '"' + identifier.replace('"', '""') + '"'
 
 
-def get_schema_text() -> str:
-    """
-    Returns a human-readable schema description
-    for use in LLM prompts.
+# Tables, columns, PK/FK constraints and indexes in one round trip.
+# reltuples is the planner's row estimate, kept current by (auto)analyze.
+CATALOG_QUERY = """
+SELECT
+    c.relname AS table_name,
+    c.reltuples::bigint AS estimated_rows,
+    (
+        SELECT json_agg(json_build_object(
+            'name', a.attname,
+            'type', format_type(a.atttypid, a.atttypmod),
+            'nullable', NOT a.attnotnull
+        ) ORDER BY a.attnum)
+        FROM pg_attribute a
+        WHERE a.attrelid = c.oid
+          AND a.attnum > 0
+          AND NOT a.attisdropped
+    ) AS columns,
+    (
+        SELECT json_agg(json_build_object(
+            'type', con.contype,
+            'columns', (
+                SELECT json_agg(att.attname ORDER BY k.ord)
+                FROM unnest(con.conkey) WITH ORDINALITY AS k(attnum, ord)
+                JOIN pg_attribute att
+                  ON att.attrelid = con.conrelid AND att.attnum = k.attnum
+            ),
+            'ref_table', ref.relname,
+            'ref_columns', (
+                SELECT json_agg(att.attname ORDER BY k.ord)
+                FROM unnest(con.confkey) WITH ORDINALITY AS k(attnum, ord)
+                JOIN pg_attribute att
+                  ON att.attrelid = con.confrelid AND att.attnum = k.attnum
+            )
+        ))
+        FROM pg_constraint con
+        LEFT JOIN pg_class ref ON ref.oid = con.confrelid
+        WHERE con.conrelid = c.oid
+          AND con.contype IN ('p', 'f')
+    ) AS constraints,
+    (
+        SELECT json_agg(json_build_object(
+            'name', ic.relname,
+            'definition', pg_get_indexdef(i.indexrelid),
+            'unique', i.indisunique,
+            'primary', i.indisprimary
+        ))
+        FROM pg_index i
+        JOIN pg_class ic ON ic.oid = i.indexrelid
+        WHERE i.indrelid = c.oid
+          AND i.indisvalid
+    ) AS indexes
+FROM pg_class c
+JOIN pg_namespace n ON n.oid = c.relnamespace
+WHERE n.nspname = 'public'
+  AND c.relkind IN ('r', 'p', 'v', 'm')
+  AND NOT (c.relname = ANY(:internal))
+  AND c.relname !~ '__(staging|old)$'
+  {table_filter}
+ORDER BY c.relname;
+"""
+
+
+# Per-table hash over everything the prompt shows: column names, types,
+# nullability and PK/FK constraints. Data loads and row counts don't move it.
+FINGERPRINT_QUERY = """
+SELECT
+    c.relname AS table_name,
+    md5(
+        string_agg(
+            a.attname || ':' || format_type(a.atttypid, a.atttypmod) || ':' || a.attnotnull,
+            ',' ORDER BY a.attnum
+        )
+        || COALESCE((
+            SELECT string_agg(pg_get_constraintdef(con.oid), ',' ORDER BY con.conname)
+            FROM pg_constraint con
+            WHERE con.conrelid = c.oid
+              AND con.contype IN ('p', 'f')
+        ), '')
+    ) AS fingerprint
+FROM pg_class c
+JOIN pg_namespace n ON n.oid = c.relnamespace
+JOIN pg_attribute a
+  ON a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped
+WHERE n.nspname = 'public'
+  AND c.relkind IN ('r', 'p', 'v', 'm')
+  AND NOT (c.relname = ANY(:internal))
+  AND c.relname !~ '__(staging|old)$'
+GROUP BY c.oid, c.relname;
+"""
+
+
+def schema_fingerprints() -> dict:
+    """{table: fingerprint}; cheap enough to poll."""
+    df = fetch_df(FINGERPRINT_QUERY, {"internal": sorted(INTERNAL_TABLES)})
+    return dict(zip(df["table_name"], df["fingerprint"]))
+
+
+def _build_table(row) -> Table:
+    table = Table(name=row["table_name"])
+
+    estimate = row["estimated_rows"]
+    table.row_count = int(estimate) if estimate is not None and estimate >= 0 else None
+
+    table.columns = [
+        Column(c["name"], c["type"], c["nullable"])
+        for c in row["columns"] or []
+    ]
+
+    for con in row["constraints"] or []:
+        if con["type"] == "p":
+            table.primary_key = con["columns"]
+        else:
+            table.foreign_keys.append(
+                ForeignKey(con["columns"], con["ref_table"], con["ref_columns"])
+            )
+
+    table.indexes = [
+        Index(i["name"], i["definition"], i["unique"], i["primary"])
+        for i in row["indexes"] or []
+    ]
+
+    return table
+
+
+def _exact_counts(table_names: list) -> dict:
+    """COUNT(*) for every table, still in a single round trip."""
+    if not table_names:
+        return {}
+
+    union = "\nUNION ALL\n".join(
+        f"SELECT :t{i} AS table_name, COUNT(*) AS cnt FROM {quote_identifier(name)}"
+        for i, name in enumerate(table_names)
+    )
+    params = {f"t{i}": name for i, name in enumerate(table_names)}
+
+    df = fetch_df(union, params)
+    return dict(zip(df["table_name"], df["cnt"].astype(int)))
+
+
+def introspect_schema(exact_counts: bool = False, tables: list = None) -> DatabaseSchema:
     """
-    tables_query = """
-    SELECT table_name
-    FROM information_schema.tables
-    WHERE table_schema = 'public'
-    ORDER BY table_name;
+    Structured schema of the public namespace from one catalog query.
+    Row counts are planner estimates unless exact_counts is set.
+    `tables` restricts introspection to the given table names.
     """
+    params = {"internal": sorted(INTERNAL_TABLES)}
+    table_filter = ""
 
-    tables_df = fetch_df(tables_query)
+    if tables is not None:
+        table_filter = "AND c.relname = ANY(:tables)"
+        params["tables"] = list(tables)
 
-    if tables_df.empty:
-        return "No tables found in database."
+    df = fetch_df(CATALOG_QUERY.format(table_filter=table_filter), params)
+
+    schema = DatabaseSchema()
+
+    for row in df.to_dict(orient="records"):
+        table = _build_table(row)
+        schema.tables[table.name] = table
 
-    schema_lines = []
+    if exact_counts:
+        for name, count in _exact_counts(schema.table_names()).items():
+            schema.tables[name].row_count = count
+            schema.tables[name].row_count_exact = True
 
-    for table in tables_df["table_name"]:
-        cols_query = """
-        SELECT column_name, data_type
-        FROM information_schema.columns
-        WHERE table_schema = 'public'
-          AND table_name = :table
-        ORDER BY ordinal_position;
-        """
-        cols_df = fetch_df(cols_query, {"table": table})
+    return schema
 
-        columns = [
-            f"{row['column_name']} ({row['data_type']})"
-            for _, row in cols_df.iterrows()
-        ]
 
-        quoted_table = quote_identifier(table)
-        count_query = f"SELECT COUNT(*) AS cnt FROM {quoted_table};"
-        count_df = fetch_df(count_query)
+def render_table_text(table: Table) -> str:
+    columns = [f"{c.name} ({c.data_type})" for c in table.columns]
 
-        row_count = int(count_df.iloc[0]["cnt"])
+    if table.row_count is None:
+        rows = "row count unknown"
+    elif table.row_count_exact:
+        rows = f"{table.row_count} rows"
+    else:
+        rows = f"~{table.row_count} rows"
 
-        schema_lines.append(
-            f"Table: {table} - {row_count} rows\n"
-            f"Columns: {', '.join(columns)}"
+    lines = [
+        f"Table: {table.name} - {rows}",
+        f"Columns: {', '.join(columns)}"
+    ]
+
+    if table.primary_key:
+        lines.append(f"Primary key: {', '.join(table.primary_key)}")
+
+    for fk in table.foreign_keys:
+        lines.append(
+            f"Foreign key: ({', '.join(fk.columns)}) -> "
+            f"{fk.ref_table} ({', '.join(fk.ref_columns)})"
         )
 
-    return "\n\n".join(schema_lines)
+    return "\n".join(lines)
+
+
+def render_schema_text(schema: DatabaseSchema) -> str:
+    """
+    Returns a human-readable schema description
+    for use in LLM prompts.
+    """
+    if not schema.tables:
+        return "No tables found in database."
+
+    return "\n\n".join(
+        render_table_text(schema.tables[name])
+        for name in schema.table_names()
+    )
+
+
+def get_schema_text(exact_counts: bool = False) -> str:
+    return render_schema_text(introspect_schema(exact_counts=exact_counts))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,225 @@
+import asyncio
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+from langchain_core.messages import AIMessage
+from langchain_core.runnables import RunnableLambda
+
+# live:   call the model, reuse identical prompts from the disk cache
+# record: always call the model and (over)write the cache
+# replay: answer only from the cache; a miss is an error, never a call
+LLM_MODE = os.getenv("LLM_MODE", "live").lower()
+
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE", "1") == "1"
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", os.path.join(".cache", "llm_responses.sqlite3"))
+
+# Fixed latency for replayed responses, so benchmarks are repeatable
+LLM_REPLAY_LATENCY_MS = float(os.getenv("LLM_REPLAY_LATENCY_MS", 0))
+
+MODES = ("live", "record", "replay")
+
+
+class LLMReplayMissError(LookupError):
+    """Replay mode found no recorded response for a prompt."""
+
+
+def prompt_key(model: str, temperature: float, prompt_text: str) -> str:
+    digest = hashlib.sha256(
+        f"{model}\x00{temperature}\x00{prompt_text}".encode("utf-8")
+    ).hexdigest()
+    return f"{model}:{digest}"
+
+
+class ResponseStore:
+    """Recorded responses in a local SQLite file, shared across restarts."""
+
+    def __init__(self, path: str = LLM_CACHE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS llm_responses (
+                    prompt_key TEXT PRIMARY KEY,
+                    model TEXT,
+                    temperature REAL,
+                    content TEXT,
+                    latency_ms REAL,
+                    created_at REAL
+                )
+            """)
+            self._conn.commit()
+
+    def get(self, key: str):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT content FROM llm_responses WHERE prompt_key = ?",
+                (key,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def put(self, key: str, model: str, temperature: float, content: str, latency_ms: float):
+        with self._lock:
+            self._conn.execute(
+                """
+                INSERT OR REPLACE INTO llm_responses
+                (prompt_key, model, temperature, content, latency_ms, created_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                """,
+                (key, model, temperature, content, latency_ms, time.time())
+            )
+            self._conn.commit()
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM llm_responses")
+            self._conn.commit()
+
+
+class LLMProvider:
+    """
+    Turns a rendered prompt into an AIMessage. Plugged into the LangChain
+    pipeline with as_runnable(), so callbacks (token usage) still flow.
+    """
+
+    model = "unknown"
+    temperature = 0.0
+
+    def invoke(self, prompt_value, config=None) -> AIMessage:
+        raise NotImplementedError
+
+    async def ainvoke(self, prompt_value, config=None) -> AIMessage:
+        return await asyncio.to_thread(self.invoke, prompt_value, config)
+
+    def as_runnable(self):
+        # RunnableLambda passes the per-call config (callbacks) through
+        def invoke(prompt_value, config):
+            return self.invoke(prompt_value, config)
+
+        async def ainvoke(prompt_value, config):
+            return await self.ainvoke(prompt_value, config)
+
+        return RunnableLambda(invoke, afunc=ainvoke, name=f"llm-provider:{self.model}")
+
+
+class ChatModelProvider(LLMProvider):
+    """Live calls to a LangChain chat model."""
+
+    def __init__(self, chat_model):
+        self.chat_model = chat_model
+        self.model = getattr(chat_model, "model_name", None) or type(chat_model).__name__
+        self.temperature = getattr(chat_model, "temperature", None) or 0.0
+
+    def invoke(self, prompt_value, config=None) -> AIMessage:
+        return self.chat_model.invoke(prompt_value, config=config)
+
+    async def ainvoke(self, prompt_value, config=None) -> AIMessage:
+        return await self.chat_model.ainvoke(prompt_value, config=config)
+
+
+class CachingProvider(LLMProvider):
+    """
+    Wraps another provider with the on-disk response cache, keyed on
+    (model, temperature, rendered prompt). Cached answers cost nothing:
+    the model is not called, so no tokens are reported.
+
+    `accept(content) -> bool` decides what may be recorded and replayed;
+    a rejected completion (e.g. unsafe SQL) is returned to the caller
+    but never stored, so the next call asks the model again.
+    """
+
+    def __init__(self, inner: LLMProvider, store: ResponseStore, mode: str = LLM_MODE,
+                 accept=None):
+        if mode not in MODES:
+            raise ValueError(f"LLM_MODE must be one of {MODES}, got {mode!r}")
+
+        self.inner = inner
+        self.store = store
+        self.mode = mode
+        self.accept = accept or (lambda content: True)
+        self.model = inner.model
+        self.temperature = inner.temperature
+        self.stats = {"hits": 0, "misses": 0, "recorded": 0, "rejected": 0}
+
+    def _key(self, prompt_value) -> str:
+        return prompt_key(self.model, self.temperature, prompt_value.to_string())
+
+    def _lookup(self, key: str):
+        if self.mode == "record":
+            return None
+
+        content = self.store.get(key)
+
+        # Entries recorded before validation existed may not pass it
+        if content is not None and self.accept(content):
+            self.stats["hits"] += 1
+            return AIMessage(content=content)
+
+        self.stats["misses"] += 1
+
+        if self.mode == "replay":
+            raise LLMReplayMissError(
+                f"No recorded LLM response for prompt {key} in {self.store.path}"
+            )
+
+        return None
+
+    def _record(self, key: str, message: AIMessage, start: float):
+        if not self.accept(message.content):
+            self.stats["rejected"] += 1
+            return
+
+        latency_ms = (time.perf_counter() - start) * 1000
+        self.store.put(key, self.model, self.temperature, message.content, latency_ms)
+        self.stats["recorded"] += 1
+
+    def invoke(self, prompt_value, config=None) -> AIMessage:
+        key = self._key(prompt_value)
+
+        cached = self._lookup(key)
+        if cached is not None:
+            if LLM_REPLAY_LATENCY_MS:
+                time.sleep(LLM_REPLAY_LATENCY_MS / 1000)
+            return cached
+
+        start = time.perf_counter()
+        message = self.inner.invoke(prompt_value, config)
+        self._record(key, message, start)
+        return message
+
+    async def ainvoke(self, prompt_value, config=None) -> AIMessage:
+        key = self._key(prompt_value)
+
+        cached = await asyncio.to_thread(self._lookup, key)
+        if cached is not None:
+            if LLM_REPLAY_LATENCY_MS:
+                await asyncio.sleep(LLM_REPLAY_LATENCY_MS / 1000)
+            return cached
+
+        start = time.perf_counter()
+        message = await self.inner.ainvoke(prompt_value, config)
+        await asyncio.to_thread(self._record, key, message, start)
+        return message
+
+
+def build_provider(chat_model, mode: str = LLM_MODE, accept=None) -> LLMProvider:
+    """
+    Live provider for `chat_model`, behind the disk cache unless disabled.
+    Only completions for which accept(content) is true are cached.
+    """
+    provider = ChatModelProvider(chat_model)
+
+    if mode == "live" and not LLM_CACHE_ENABLED:
+        return provider
+
+    return CachingProvider(provider, ResponseStore(), mode, accept)
@@ -0,0 +1,198 @@
+import json
+import os
+import re
+
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+
+from db.db_connection import fetch_scalar, get_async_engine
+
+# Planner estimates above these limits are not executed as-is
+MAX_COST = float(os.getenv("GUARD_MAX_COST", 1_000_000))
+MAX_ROWS = int(os.getenv("GUARD_MAX_ROWS", 100_000))
+
+# LIMIT injected into queries expected to return more than MAX_ROWS
+INJECTED_LIMIT = int(os.getenv("GUARD_INJECTED_LIMIT", 10_000))
+
+# Per-request statement_timeout for approved queries
+STATEMENT_TIMEOUT_MS = int(os.getenv("STATEMENT_TIMEOUT_MS", 15_000))
+
+# A trailing row limit in any spelling Postgres accepts: LIMIT n / ALL /
+# a bind parameter, with OFFSET before or after, or FETCH FIRST|NEXT
+_ROW_COUNT = r"(?:\d+|ALL|:\w+|\$\d+)"
+_OFFSET = r"OFFSET\s+\S+(?:\s+ROWS?)?"
+_TRAILING_LIMIT = re.compile(
+    rf"\b(?:LIMIT\s+(?P<count>{_ROW_COUNT})(?:\s+{_OFFSET})?"
+    rf"|{_OFFSET}\s+LIMIT\s+(?P<count_after_offset>{_ROW_COUNT})"
+    rf"|(?:{_OFFSET}\s+)?FETCH\s+(?:FIRST|NEXT)\s+(?:\S+\s+)?ROWS?\s+(?:ONLY|WITH\s+TIES))\s*$",
+    re.IGNORECASE
+)
+
+
+class QueryRejectedError(ValueError):
+    """Estimated cost of a generated query is over the configured budget."""
+
+    def __init__(self, message: str, decision: dict):
+        super().__init__(message)
+        self.decision = decision
+
+
+def _explain_sql(sql: str) -> str:
+    return f"EXPLAIN (FORMAT JSON) {sql}"
+
+
+def _plan_estimates(raw) -> tuple:
+    """(total_cost, plan_rows) of the top plan node."""
+    if isinstance(raw, str):
+        raw = json.loads(raw)
+
+    plan = raw[0]["Plan"]
+    return float(plan["Total Cost"]), int(plan["Plan Rows"])
+
+
+def strip_comments(sql: str) -> str:
+    """Drop -- and /* */ comments outside string literals and quoted identifiers."""
+    out, i, quote = [], 0, None
+
+    while i < len(sql):
+        ch = sql[i]
+
+        if quote:
+            out.append(ch)
+            if ch == quote:
+                quote = None
+            i += 1
+        elif ch in ("'", '"'):
+            quote = ch
+            out.append(ch)
+            i += 1
+        elif sql.startswith("--", i):
+            end = sql.find("\n", i)
+            i = len(sql) if end == -1 else end
+        elif sql.startswith("/*", i):
+            end = sql.find("*/", i + 2)
+            i = len(sql) if end == -1 else end + 2
+            out.append(" ")
+        else:
+            out.append(ch)
+            i += 1
+
+    return "".join(out)
+
+
+def strip_semicolon(sql: str) -> str:
+    # A trailing comment would otherwise hide the semicolon, and swallow
+    # or hide a LIMIT appended after it
+    return strip_comments(sql).strip().rstrip(";").strip()
+
+
+def has_limit(sql: str) -> bool:
+    """True when the query ends in a real row limit (LIMIT ALL is none)."""
+    match = _TRAILING_LIMIT.search(strip_semicolon(sql))
+    if match is None:
+        return False
+
+    count = match.group("count") or match.group("count_after_offset")
+    return not (count and count.upper() == "ALL")
+
+
+def inject_limit(sql: str, limit: int = INJECTED_LIMIT) -> str:
+    # Wrapped rather than appended: valid whatever the query ends with
+    # (LIMIT ALL, FETCH, OFFSET, UNION, ...)
+    return f"SELECT * FROM (\n{strip_semicolon(sql)}\n) q\nLIMIT {limit}"
+
+
+def _decision(cost: float, rows: int) -> dict:
+    return {
+        "decision": "approved",
+        "estimated_cost": cost,
+        "estimated_rows": rows,
+        "limit_injected": False,
+        "statement_timeout_ms": STATEMENT_TIMEOUT_MS
+    }
+
+
+def _should_limit(sql: str, rows: int) -> bool:
+    return rows > MAX_ROWS and not has_limit(sql)
+
+
+def _limited(decision: dict, cost: float, rows: int):
+    decision.update(
+        decision="rewritten",
+        limit_injected=True,
+        estimated_cost=cost,
+        estimated_rows=rows
+    )
+
+
+def _enforce_cost(decision: dict):
+    if decision["estimated_cost"] > MAX_COST:
+        decision["decision"] = "rejected"
+        raise QueryRejectedError(
+            f"Query rejected: estimated cost {decision['estimated_cost']:.0f} "
+            f"exceeds limit {MAX_COST:.0f}",
+            decision
+        )
+
+
+def _invalid(sql: str, e: DBAPIError):
+    """
+    EXPLAIN failing on the statement itself (syntax error, unknown column)
+    means the query can never run: reject it. Lost connections re-raise.
+    """
+    if e.connection_invalidated:
+        raise e
+
+    message = str(getattr(e, "orig", None) or e).strip().splitlines()[0]
+    return QueryRejectedError(
+        f"Query rejected: invalid SQL: {message}",
+        {"decision": "rejected", "error": message, "statement_timeout_ms": STATEMENT_TIMEOUT_MS}
+    )
+
+
+def _explain(sql: str) -> tuple:
+    try:
+        return _plan_estimates(fetch_scalar(_explain_sql(sql)))
+    except DBAPIError as e:
+        raise _invalid(sql, e) from e
+
+
+async def _explain_async(sql: str) -> tuple:
+    try:
+        async with get_async_engine().connect() as conn:
+            result = await conn.execute(text(_explain_sql(sql)))
+            return _plan_estimates(result.scalar())
+    except DBAPIError as e:
+        raise _invalid(sql, e) from e
+
+
+def guard_sql(sql: str):
+    """
+    EXPLAIN the query and return (sql_to_run, decision). Queries expected
+    to return more than GUARD_MAX_ROWS get a LIMIT; QueryRejectedError is
+    raised when the estimated cost is over GUARD_MAX_COST or the SQL
+    does not plan at all (syntax error, unknown table or column).
+    """
+    sql = strip_semicolon(sql)
+    cost, rows = _explain(sql)
+    decision = _decision(cost, rows)
+
+    if _should_limit(sql, rows):
+        sql = inject_limit(sql)
+        _limited(decision, *_explain(sql))
+
+    _enforce_cost(decision)
+    return sql, decision
+
+
+async def guard_sql_async(sql: str):
+    sql = strip_semicolon(sql)
+    cost, rows = await _explain_async(sql)
+    decision = _decision(cost, rows)
+
+    if _should_limit(sql, rows):
+        sql = inject_limit(sql)
+        _limited(decision, *await _explain_async(sql))
+
+    _enforce_cost(decision)
+    return sql, decision
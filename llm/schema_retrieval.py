@@ -0,0 +1,197 @@
+import math
+import os
+import re
+from collections import Counter
+from functools import lru_cache
+
+from db.db_connection import fetch_df
+from db.schema_introspect import is_internal_table, quote_identifier, render_table_text
+
+TOP_K = int(os.getenv("SCHEMA_TOP_K", 3))
+
+# Below this BM25 score the question is too vague to prune safely
+MIN_SCORE = float(os.getenv("SCHEMA_MIN_SCORE", 1.0))
+
+SAMPLE_VALUES = os.getenv("SCHEMA_SAMPLE_VALUES", "1") == "1"
+SAMPLES_PER_COLUMN = int(os.getenv("SCHEMA_SAMPLES_PER_COLUMN", 50))
+USE_EMBEDDINGS = os.getenv("SCHEMA_RETRIEVAL_EMBEDDINGS", "0") == "1"
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+_TOKEN = re.compile(r"[a-z0-9]+")
+
+_TEXT_TYPES = ("text", "character varying", "character")
+
+@lru_cache(maxsize=None)
+def _encoding():
+    # Loading the BPE ranks is slow; only pay for it when counting tokens
+    try:
+        import tiktoken
+        return tiktoken.get_encoding("o200k_base")
+    except Exception:
+        return None
+
+
+def estimate_tokens(text: str) -> int:
+    encoding = _encoding()
+    if encoding is not None:
+        return len(encoding.encode(text))
+    # Rough rule of thumb for English / SQL identifiers
+    return max(1, len(text) // 4)
+
+
+def tokenize(text: str) -> list:
+    tokens = []
+    for token in _TOKEN.findall(text.lower()):
+        tokens.append(token)
+        # customers -> customer, so plural questions match singular names
+        if len(token) > 3 and token.endswith("s"):
+            tokens.append(token[:-1])
+    return tokens
+
+
+def load_sample_values(schema, tables: list = None) -> dict:
+    """
+    {table: [distinct text values]} from a bounded scan of each text
+    column, all in one UNION ALL query.
+    """
+    parts, params = [], {}
+
+    for name in tables if tables is not None else schema.table_names():
+        if is_internal_table(name):
+            continue
+
+        for column in schema.tables[name].columns:
+            if not column.data_type.startswith(_TEXT_TYPES):
+                continue
+
+            i = len(parts)
+            col = quote_identifier(column.name)
+            parts.append(
+                f"(SELECT :t{i} AS table_name, v AS value FROM ("
+                f"SELECT DISTINCT {col}::text AS v FROM ("
+                f"SELECT {col} FROM {quote_identifier(name)} LIMIT 1000"
+                f") s WHERE {col} IS NOT NULL LIMIT {SAMPLES_PER_COLUMN}) d)"
+            )
+            params[f"t{i}"] = name
+
+    if not parts:
+        return {}
+
+    df = fetch_df("\nUNION ALL\n".join(parts), params)
+
+    samples = {}
+    for table, value in zip(df["table_name"], df["value"]):
+        samples.setdefault(table, []).append(value)
+    return samples
+
+
+class SchemaIndex:
+    """
+    BM25 index with one document per table: its name, column names and
+    (optionally) sample values. Built once per schema version.
+    """
+
+    def __init__(self, schema, samples: dict = None, embedder=None):
+        self.schema = schema
+        self.samples = samples or {}
+        self.names = [n for n in schema.table_names() if not is_internal_table(n)]
+        self.docs = []
+
+        for name in self.names:
+            table = schema.tables[name]
+            text = " ".join(
+                [name, name]  # table name weighs more than a column name
+                + [c.name for c in table.columns]
+                + self.samples.get(name, [])
+            )
+            self.docs.append(Counter(tokenize(text)))
+
+        self.avg_len = sum(sum(d.values()) for d in self.docs) / max(len(self.docs), 1)
+
+        df = Counter(t for doc in self.docs for t in doc)
+        n = len(self.docs)
+        self.idf = {t: math.log(1 + (n - f + 0.5) / (f + 0.5)) for t, f in df.items()}
+
+        self.embedder = embedder
+        self.table_vectors = None
+
+        if embedder is not None and self.names:
+            self.table_vectors = embedder.embed(
+                [render_table_text(schema.tables[n]) for n in self.names]
+            )
+
+    def scores(self, question: str) -> dict:
+        terms = set(tokenize(question))
+        scores = {}
+
+        for name, doc in zip(self.names, self.docs):
+            length = sum(doc.values())
+            score = 0.0
+
+            for term in terms:
+                tf = doc.get(term, 0)
+                if tf:
+                    norm = tf + K1 * (1 - B + B * length / self.avg_len)
+                    score += self.idf[term] * tf * (K1 + 1) / norm
+
+            scores[name] = score
+
+        if self.table_vectors is not None:
+            similarity = self.table_vectors @ self.embedder.embed([question])[0]
+            for name, sim in zip(self.names, similarity):
+                scores[name] += float(sim)
+
+        return scores
+
+    def select_tables(self, question: str, top_k: int = TOP_K):
+        """
+        Top-k relevant tables plus their foreign-key neighbours,
+        or None when the match is too weak to trust.
+        """
+        scores = self.scores(question)
+        ranked = sorted(
+            (n for n in self.names if scores[n] > 0),
+            key=lambda n: -scores[n]
+        )
+
+        if not ranked or scores[ranked[0]] < MIN_SCORE:
+            return None
+
+        selected = set(ranked[:top_k])
+
+        for name in list(selected):
+            table = self.schema.tables[name]
+            selected.update(fk.ref_table for fk in table.foreign_keys)
+
+        # Tables referencing a selected one are neighbours too
+        for name in self.names:
+            if any(fk.ref_table in selected for fk in self.schema.tables[name].foreign_keys):
+                selected.add(name)
+
+        return sorted(t for t in selected if t in self.schema.tables)
+
+
+def build_index(schema, previous: SchemaIndex = None, changed: list = None) -> SchemaIndex:
+    """
+    With `previous` and `changed`, sample values are only re-read for
+    the changed tables; everything else is reused.
+    """
+    samples = None
+
+    if SAMPLE_VALUES:
+        if previous is not None and changed is not None:
+            samples = {t: v for t, v in previous.samples.items() if t not in changed}
+            present = [t for t in changed if t in schema.tables]
+            samples.update(load_sample_values(schema, present))
+        else:
+            samples = load_sample_values(schema)
+
+    embedder = None
+    if USE_EMBEDDINGS:
+        from cache.semantic_cache import get_embedder
+        embedder = get_embedder()
+
+    return SchemaIndex(schema, samples, embedder)
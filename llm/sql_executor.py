@@ -1,91 +1,153 @@
-from db.db_connection import fetch_df
-from llm.text_to_sql import generate_sql
+import asyncio
+import contextlib
+import os
+import threading
+import time
+
+import pandas as pd
+
+from db.db_connection import iter_df_chunks_async
+from llm.text_to_sql import check_schema_async, generate_sql_async, generate_sql_batch_async
+from llm.query_guard import QueryRejectedError, STATEMENT_TIMEOUT_MS, guard_sql_async
 
 from cache.tier1_cache import get_l1, set_l1
-from cache.tier2_cache import get_cached_result, save_to_cache
+from cache.tier2_cache import (
+    get_cached_result_async,
+    get_cached_result_by_key_async,
+    get_cached_results_async,
+    record_hit,
+    save_to_cache_async
+)
+from cache.semantic_cache import find_similar, add_question
+from cache.plan_cache import get_plan, invalidate_plan, save_plan
+from cache.single_flight import single_flight_async, advisory_lock_async
+from cache.normalize import make_cache_key
+from cache.dependencies import dependencies_for_sql_async, is_fresh, refresh_versions_async
 from cache.cache_metrics import (
     record_l1_hit,
     record_l2_hit,
+    record_semantic_hit,
+    record_plan_hit,
+    record_coalesced,
     record_miss,
     get_metrics,
-    hit_rate
+    hit_rate,
+    timed
 )
 
 from observability.langfuse_client import langfuse
-import time
 
+# Also serialize misses across worker processes via pg_advisory_lock
+CROSS_PROCESS_SINGLE_FLIGHT = os.getenv("SINGLE_FLIGHT_ADVISORY_LOCK", "0") == "1"
 
-def answer_question(question: str):
+# Results are streamed from a server-side cursor in chunks and cut off
+# at FETCH_MAX_ROWS; only results within the CACHE_* caps are cached.
+FETCH_CHUNK_ROWS = int(os.getenv("FETCH_CHUNK_ROWS", 5000))
+FETCH_MAX_ROWS = int(os.getenv("FETCH_MAX_ROWS", 100_000))
+CACHE_MAX_ROWS = int(os.getenv("CACHE_MAX_ROWS", 50_000))
+CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_BYTES", 32 * 1024 * 1024))  # 32 MB
 
-    # Start ROOT TRACE (not span)
-    trace = langfuse.start_trace(
-        name="text-to-sql-request",
-        input={"question": question}
+
+async def _finish(trace, sql: str, metadata: dict):
+    trace.update(metadata=metadata, output={"sql": sql})
+    trace.end()
+
+
+async def fetch_result_async(sql: str) -> pd.DataFrame:
+    """
+    Stream the result chunk by chunk under STATEMENT_TIMEOUT_MS, stopping
+    at FETCH_MAX_ROWS. df.attrs["truncated"] tells whether rows were left
+    unread, df.attrs["execution_ms"] how long the query took and
+    df.attrs["deps"] the versions of the tables it read, taken before
+    the query ran.
+    """
+    chunks, rows, truncated = [], 0, False
+    deps = await dependencies_for_sql_async(sql)
+    start = time.perf_counter()
+
+    # aclosing: breaking out early closes the cursor and returns the
+    # connection now, not whenever the generator is garbage-collected
+    stream = iter_df_chunks_async(
+        sql,
+        chunk_rows=FETCH_CHUNK_ROWS,
+        statement_timeout_ms=STATEMENT_TIMEOUT_MS
     )
 
-    start_time = time.time()
+    with timed("sql_execution"):
+        async with contextlib.aclosing(stream) as stream:
+            async for chunk in stream:
+                room = FETCH_MAX_ROWS - rows
 
-    l1 = get_l1(question)
+                if len(chunk) > room:
+                    chunks.append(chunk.iloc[:room])
+                    truncated = True
+                    break
 
-    if l1:
-        record_l1_hit()
-        sql, df = l1
+                chunks.append(chunk)
+                rows += len(chunk)
 
-        trace.update(
-            metadata={
-                "cache_source": "L1",
-                "rows_returned": len(df)
-            },
-            output={"sql": sql}
-        )
+    df = pd.concat(chunks, ignore_index=True) if len(chunks) > 1 else chunks[0]
+    df.attrs["truncated"] = truncated
+    df.attrs["execution_ms"] = (time.perf_counter() - start) * 1000
+    df.attrs["deps"] = deps
 
-        trace.end()
-        langfuse.flush()
-        return sql, df, "L1-cache", None
+    return df
 
-    l2 = get_cached_result(question)
 
-    if l2:
-        record_l2_hit()
-        sql, df = l2
+def is_cacheable(df) -> bool:
+    if df.attrs.get("truncated") or len(df) > CACHE_MAX_ROWS:
+        return False
+    return int(df.memory_usage(deep=True).sum()) <= CACHE_MAX_BYTES
 
-        # Promote to L1
-        set_l1(question, sql, df)
 
-        trace.update(
-            metadata={
-                "cache_source": "L2",
-                "promoted_to_L1": True,
-                "rows_returned": len(df)
-            },
-            output={"sql": sql}
-        )
+async def _execute_sql(trace, sql: str, start_time: float, end_trace: bool = True):
+    """
+    Cost-check, then run the SQL. Returns (sql, df, execution_time, guard)
+    where sql may have been rewritten by the guard. With end_trace=False
+    a failure leaves the trace open, for callers that fall back.
+    """
 
-        trace.end()
-        langfuse.flush()
-        return sql, df, "L2-cache", None
+    # Child span created from TRACE
+    exec_span = trace.start_span(name="sql-execution")
 
+    try:
+        sql, guard = await guard_sql_async(sql)
 
-    record_miss()
+    except QueryRejectedError as e:
 
-    trace.update(metadata={"cache_source": "LLM"})
+        exec_span.update(output={"error": str(e)}, metadata={"guard": e.decision})
+        exec_span.end()
 
-    # SQL generation already tracked in text_to_sql.py
-    sql, usage = generate_sql(question)
+        if end_trace:
+            trace.update(level="ERROR", metadata={"guard": e.decision})
+            trace.end()
 
-    # Child span created from TRACE
-    exec_span = trace.start_span(name="sql-execution")
+        raise
+
+    except Exception as e:
+
+        # EXPLAIN itself failed (lost connection, timeout)
+        exec_span.update(output={"error": str(e)})
+        exec_span.end()
+
+        if end_trace:
+            trace.update(level="ERROR")
+            trace.end()
+
+        raise RuntimeError(f"SQL execution failed: {e}") from e
 
     try:
-        df = fetch_df(sql)
+        df = await fetch_result_async(sql)
 
         execution_time = time.time() - start_time
 
         exec_span.update(
             output={
                 "rows_returned": len(df),
+                "truncated": df.attrs["truncated"],
                 "execution_time_sec": execution_time
-            }
+            },
+            metadata={"guard": guard}
         )
         exec_span.end()
 
@@ -96,30 +158,434 @@ def answer_question(question: str):
         )
         exec_span.end()
 
-        trace.update(level="ERROR")
-        trace.end()
-        langfuse.flush()
+        if end_trace:
+            trace.update(level="ERROR")
+            trace.end()
 
         raise RuntimeError(f"SQL execution failed: {e}") from e
 
-    save_to_cache(question, sql, df)  # L2 persistent
-    set_l1(question, sql, df)         # L1 memory
+    return sql, df, execution_time, guard
+
+
+async def _store_result(key: str, question: str, sql: str, df):
+    """Returns (deps, cached); oversized or truncated results are not cached."""
+    deps = df.attrs.get("deps")
+    if deps is None:
+        deps = await dependencies_for_sql_async(sql)
+
+    if not is_cacheable(df):
+        return deps, False
+
+    with timed("cache_write"):
+        await save_to_cache_async(question, sql, df, deps)  # L2 persistent
+        set_l1(key, sql, df, deps=deps)                     # L1 memory
+
+    return deps, True
+
+
+async def answer_question_async(question: str):
 
-    trace.update(
-        metadata={
+    # Start ROOT TRACE (not span)
+    trace = langfuse.start_trace(
+        name="text-to-sql-request",
+        input={"question": question}
+    )
+
+    start_time = time.time()
+
+    # Same key for every tier, so L2 promotions land where L1 looks
+    key = make_cache_key(question)
+
+    # A schema change drops the plans and results built on the old one,
+    # so it is checked before any tier is read
+    await check_schema_async()
+
+    # is_fresh then reads the version snapshot without blocking the loop
+    await refresh_versions_async()
+
+    with timed("l1_lookup"):
+        l1 = get_l1(key, is_fresh=is_fresh)
+
+    if l1:
+        record_l1_hit()
+        record_hit(key)
+        sql, df = l1
+
+        await _finish(trace, sql, {
+            "cache_source": "L1",
+            "cache_key": key,
+            "rows_returned": len(df)
+        })
+        return sql, df, "L1-cache", None
+
+    with timed("l2_lookup"):
+        l2 = await get_cached_result_async(question)
+
+    if l2:
+        record_l2_hit()
+        record_hit(key)
+        sql, df = l2
+
+        # Promote to L1
+        set_l1(key, sql, df, deps=await dependencies_for_sql_async(sql))
+
+        await _finish(trace, sql, {
+            "cache_source": "L2",
+            "cache_key": key,
+            "promoted_to_L1": True,
+            "rows_returned": len(df)
+        })
+        return sql, df, "L2-cache", None
+
+    # Only one caller per key does the expensive work below
+    led = False
+
+    async def resolve():
+        nonlocal led
+        led = True
+
+        if not CROSS_PROCESS_SINGLE_FLIGHT:
+            return await _answer_miss(trace, key, question, start_time)
+
+        async with advisory_lock_async(key):
+            # Another worker may have filled the cache while we waited
+            with timed("l2_lookup"):
+                l2 = await get_cached_result_async(question)
+
+            if l2:
+                record_l2_hit()
+                record_hit(key)
+                sql, df = l2
+                set_l1(key, sql, df, deps=await dependencies_for_sql_async(sql))
+
+                await _finish(trace, sql, {
+                    "cache_source": "L2",
+                    "cache_key": key,
+                    "after_advisory_lock": True,
+                    "rows_returned": len(df)
+                })
+                return sql, df, "L2-cache", None
+
+            return await _answer_miss(trace, key, question, start_time)
+
+    try:
+        result, shared = await single_flight_async(key, resolve)
+
+    except Exception as e:
+        if not led:
+            trace.update(level="ERROR", output={"error": str(e)})
+            trace.end()
+        raise
+
+    if not shared:
+        return result
+
+    record_coalesced()
+    sql, df, _, _ = result
+
+    await _finish(trace, sql, {
+        "cache_source": "coalesced",
+        "cache_key": key,
+        "rows_returned": len(df)
+    })
+    return sql, df, "coalesced", None
+
+
+async def _run_plan(trace, key: str, sql: str, start_time: float):
+    """
+    Re-run a cached plan; None when it no longer runs (e.g. a reload
+    dropped a column it reads). The plan is then forgotten, so the
+    caller falls back to the semantic and LLM tiers.
+    """
+    try:
+        return await _execute_sql(trace, sql, start_time, end_trace=False)
+
+    except (QueryRejectedError, RuntimeError) as e:
+        print(f"Cached plan for {key} failed, regenerating: {e}")
+        await asyncio.to_thread(invalidate_plan, key)
+
+        trace.update(metadata={"failed_plan": key})
+        return None
+
+
+async def _answer_miss(trace, key: str, question: str, start_time: float):
+
+    # Results expired or went stale, but the SQL is still good: re-run it
+    sql = await asyncio.to_thread(get_plan, key)
+    executed = await _run_plan(trace, key, sql, start_time) if sql else None
+
+    if executed:
+        record_plan_hit()
+        sql, df, execution_time, guard = executed
+        deps, cached = await _store_result(key, question, sql, df)
+
+        await _finish(trace, sql, {
+            "cache_source": "plan",
+            "cache_key": key,
             "rows_returned": len(df),
             "execution_time_sec": execution_time,
-            "saved_to_cache": True
-        },
-        output={"sql": sql}
-    )
+            "depends_on": sorted(deps),
+            "saved_to_cache": cached,
+            "guard": guard
+        })
+        return sql, df, "plan-cache", None
+
+    # Semantic tier: reuse a near-duplicate question's result or SQL
+    match = await asyncio.to_thread(find_similar, question)
+
+    if match:
+        matched_key, matched_question, score = match
+        metadata = {
+            "cache_source": "semantic",
+            "cache_key": key,
+            "matched_key": matched_key,
+            "matched_question": matched_question,
+            "similarity": score
+        }
+
+        cached = await get_cached_result_by_key_async(matched_key)
+
+        if cached:
+            record_semantic_hit()
+            sql, df = cached
+
+            set_l1(key, sql, df, deps=await dependencies_for_sql_async(sql))
+
+            await _finish(trace, sql, {**metadata, "rows_returned": len(df)})
+            return sql, df, "semantic-cache", None
+
+        sql = await asyncio.to_thread(get_plan, matched_key)
+        executed = await _run_plan(trace, matched_key, sql, start_time) if sql else None
+
+        if executed:
+            record_semantic_hit()
+            sql, df, execution_time, guard = executed
+            _, cached = await _store_result(key, question, sql, df)
+
+            await _finish(trace, sql, {
+                **metadata,
+                "reexecuted_plan": True,
+                "rows_returned": len(df),
+                "execution_time_sec": execution_time,
+                "saved_to_cache": cached,
+                "guard": guard
+            })
+            return sql, df, "semantic-cache", None
 
-    trace.end()
-    langfuse.flush()
+    record_miss()
+
+    trace.update(metadata={"cache_source": "LLM", "cache_key": key})
+
+    # SQL generation already tracked in text_to_sql.py
+    sql, usage = await generate_sql_async(question)
+
+    sql, df, execution_time, guard = await _execute_sql(trace, sql, start_time)
+
+    deps, cached = await _store_result(key, question, sql, df)
+    await asyncio.to_thread(save_plan, key, question, sql, list(deps))  # question -> SQL
+    await asyncio.to_thread(add_question, key, question)                # semantic index
+
+    await _finish(trace, sql, {
+        "rows_returned": len(df),
+        "truncated": df.attrs["truncated"],
+        "execution_time_sec": execution_time,
+        "depends_on": sorted(deps),
+        "saved_to_cache": cached,
+        "guard": guard
+    })
 
     return sql, df, "LLM", usage
 
+
+async def answer_questions_async(questions: list, concurrency: int = 4):
+    """
+    Answer many questions at once. Duplicates (same cache key) are
+    resolved once, cache hits come from one bulk L2 query, misses share
+    one batched LLM call and their SQL runs in parallel over the pool.
+
+    Returns one dict per input, in input order:
+    {question, sql, df, source, latency_ms, usage, error}. latency_ms is
+    the time spent on that item: its lookup, plus its share of the
+    batched LLM call and its own SQL job for misses.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    keys = [make_cache_key(q) for q in questions]
+
+    # First question seen for each key is the one we answer
+    unique = {}
+    for key, question in zip(keys, questions):
+        unique.setdefault(key, question)
+
+    resolved = {}
+
+    def resolve(key, sql, df, source, usage=None, error=None, started=None, offset_ms=0.0):
+        resolved[key] = {
+            "sql": sql,
+            "df": df,
+            "source": source,
+            "latency_ms": offset_ms + (time.perf_counter() - started) * 1000,
+            "usage": usage,
+            "error": error
+        }
+
+    await check_schema_async()
+    await refresh_versions_async()
+
+    for key in unique:
+        started = time.perf_counter()
+        with timed("l1_lookup"):
+            l1 = get_l1(key, is_fresh=is_fresh)
+        if l1:
+            record_l1_hit()
+            record_hit(key)
+            resolve(key, *l1, "L1-cache", started=started)
+
+    pending = [k for k in unique if k not in resolved]
+
+    # A failed lookup below degrades to a miss for the keys it covered
+    started = time.perf_counter()
+    try:
+        with timed("l2_lookup"):
+            l2_hits = await get_cached_results_async(pending)
+    except Exception as e:
+        print(f"Batch L2 lookup failed, treating {len(pending)} keys as misses: {e}")
+        l2_hits = {}
+
+    for key, (sql, df) in l2_hits.items():
+        record_l2_hit()
+        record_hit(key)
+        try:
+            set_l1(key, sql, df, deps=await dependencies_for_sql_async(sql))
+        except Exception as e:
+            print(f"L1 promotion failed for {key}: {e}")
+        resolve(key, sql, df, "L2-cache", started=started)
+
+    pending = [k for k in pending if k not in resolved]
+
+    async def run(key, sql, source, usage=None, offset_ms=0.0):
+        started = time.perf_counter()
+
+        def fail(error):
+            resolve(key, sql, None, source, usage, error, started, offset_ms)
+
+        # One question's failure must never discard the rest of the batch
+        try:
+            async with semaphore:
+                try:
+                    sql, _ = await guard_sql_async(sql)
+                except QueryRejectedError as e:
+                    fail(str(e))
+                    return
+
+                try:
+                    df = await fetch_result_async(sql)
+                except Exception as e:
+                    fail(f"SQL execution failed: {e}")
+                    return
+
+                deps, _ = await _store_result(key, unique[key], sql, df)
+
+                if source == "LLM":
+                    await asyncio.to_thread(save_plan, key, unique[key], sql, list(deps))
+                    await asyncio.to_thread(add_question, key, unique[key])
+
+                resolve(key, sql, df, source, usage, None, started, offset_ms)
+
+        except Exception as e:
+            fail(f"SQL execution failed: {e}")
+
+    lookups = await asyncio.gather(
+        *(asyncio.to_thread(get_plan, k) for k in pending),
+        return_exceptions=True
+    )
+    plans = {}
+
+    for key, plan in zip(pending, lookups):
+        if isinstance(plan, Exception):
+            print(f"Plan lookup failed for {key}, regenerating: {plan}")
+            plan = None
+        plans[key] = plan
+
+    to_generate = [k for k in pending if not plans[k]]
+
+    for key in pending:
+        if plans[key]:
+            record_plan_hit()
+        else:
+            record_miss()
+
+    started = time.perf_counter()
+    generated = await generate_sql_batch_async(
+        [unique[k] for k in to_generate],
+        concurrency=concurrency
+    )
+    generation_ms = (time.perf_counter() - started) * 1000
+
+    jobs = [run(k, plans[k], "plan-cache") for k in pending if plans[k]]
+
+    for key, outcome in zip(to_generate, generated):
+        if isinstance(outcome, Exception):
+            resolve(key, None, None, "LLM", error=str(outcome), started=started)
+        else:
+            sql, usage = outcome
+            jobs.append(run(key, sql, "LLM", usage, offset_ms=generation_ms))
+
+    await asyncio.gather(*jobs)
+
+    results = []
+    answered = set()
+
+    for key, question in zip(keys, questions):
+        item = {"question": question, **resolved[key]}
+
+        # Repeats in the batch did not cost anything extra
+        if key in answered:
+            item["usage"] = None
+        answered.add(key)
+
+        results.append(item)
+
+    return results
+
+
+# The sync API drives the async pipeline on one long-lived event loop,
+# so the async engine's connection pool is reused across calls.
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def _get_loop():
+    global _loop
+
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(
+                target=_loop.run_forever,
+                name="text-to-sql-loop",
+                daemon=True
+            ).start()
+
+    return _loop
+
+
+def run_sync(coro):
+    """Run a coroutine on the shared background loop and wait for it."""
+    return asyncio.run_coroutine_threadsafe(coro, _get_loop()).result()
+
+
+def answer_question(question: str):
+    return run_sync(answer_question_async(question))
+
+
+def answer_questions(questions: list, concurrency: int = 4):
+    return run_sync(answer_questions_async(questions, concurrency))
+
 if __name__ == "__main__":
+    from db.migrations import init
+
+    init()
 
     questions = [
         "Show all customers who are from alabama",
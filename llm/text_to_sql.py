@@ -1,30 +1,60 @@
+import asyncio
 import sys
 import os
+import threading
+import time
+from functools import lru_cache
 sys.path.append(os.path.dirname(os.path.dirname(__file__)))
 
 from dotenv import load_dotenv
-import streamlit as st
 
-from langchain_openai import ChatOpenAI
 from langchain_core.prompts import ChatPromptTemplate
 
-from db.schema_introspect import get_schema_text
+from db.schema_introspect import (
+    DatabaseSchema,
+    introspect_schema,
+    render_schema_text,
+    render_table_text,
+    schema_fingerprints
+)
+from cache.invalidation import invalidate_tables
+from cache.plan_cache import invalidate_plans
+from cache.cache_metrics import record_usage, timed
+from llm.schema_retrieval import build_index, estimate_tokens
+from llm.llm_provider import LLM_MODE, build_provider
+
 
-try:
-    from langchain_community.callbacks.manager import get_openai_callback
-except ImportError:
-    # Fallback if langchain_community is not available
-    from contextlib import contextmanager
-    @contextmanager
-    def get_openai_callback():
-        class CB:
+@lru_cache(maxsize=None)
+def _openai_callbacks():
+    """(get_openai_callback, OpenAICallbackHandler), imported on first use."""
+    try:
+        from langchain_community.callbacks.manager import get_openai_callback
+        from langchain_community.callbacks.openai_info import OpenAICallbackHandler
+    except ImportError:
+        # Fallback if langchain_community is not available
+        from contextlib import contextmanager
+        from langchain_core.callbacks import BaseCallbackHandler
+
+        class OpenAICallbackHandler(BaseCallbackHandler):
             prompt_tokens = 0
             completion_tokens = 0
             total_tokens = 0
             total_cost = 0.0
-        yield CB()
+
+        @contextmanager
+        def get_openai_callback():
+            yield OpenAICallbackHandler()
+
+    return get_openai_callback, OpenAICallbackHandler
 
 
+def get_openai_callback():
+    return _openai_callbacks()[0]()
+
+
+def _callback_handler():
+    return _openai_callbacks()[1]()
+
 
 load_dotenv()
 
@@ -33,44 +63,179 @@ from observability.langfuse_client import langfuse
 
 def get_secret(key: str):
     """Works locally (.env) and on Streamlit Cloud."""
+    # Only the app imports streamlit; CLIs and workers read the environment
+    st = sys.modules.get("streamlit")
     try:
-        if key in st.secrets:
+        if st is not None and key in st.secrets:
             return st.secrets[key]
     except Exception:
         pass
     return os.getenv(key)
 
 
-OPENAI_API_KEY = get_secret("OPENAI_API_KEY")
+def get_openai_api_key() -> str:
+    key = get_secret("OPENAI_API_KEY")
 
-if not OPENAI_API_KEY:
-    raise ValueError("OPENAI_API_KEY not found")
+    if not key:
+        # Replay never calls OpenAI, so CI can run without a key
+        if LLM_MODE != "replay":
+            raise ValueError("OPENAI_API_KEY not found")
+        return "replay-only"
 
-print("OpenAI API Key loaded successfully")
+    print("OpenAI API Key loaded successfully")
+    return key
 
 
-llm = ChatOpenAI(
-    model="gpt-4.1-mini",
-    temperature=0
-)
-
+# Seconds between schema fingerprint checks
+SCHEMA_CHECK_INTERVAL = float(os.getenv("SCHEMA_CHECK_INTERVAL", 60))
 
 _SCHEMA = None
+_SCHEMA_INFO = None
+_SCHEMA_INDEX = None
+_SCHEMA_TOKENS = 0
+_SCHEMA_FINGERPRINTS = {}
+_SCHEMA_CHECKED_AT = 0.0
+_schema_lock = threading.RLock()
+
+
+def _render_schema(index):
+    global _SCHEMA, _SCHEMA_INDEX, _SCHEMA_TOKENS
+    _SCHEMA_INDEX = index
+    _SCHEMA = render_schema_text(_SCHEMA_INFO)
+    _SCHEMA_TOKENS = estimate_tokens(_SCHEMA)
+
+
+def _changed_tables(fingerprints: dict) -> list:
+    # The first fingerprints seen in this process are the baseline
+    if not _SCHEMA_FINGERPRINTS:
+        return []
+
+    return sorted(
+        t for t in set(fingerprints) | set(_SCHEMA_FINGERPRINTS)
+        if fingerprints.get(t) != _SCHEMA_FINGERPRINTS.get(t)
+    )
+
+
+def _invalidate_changed(changed: list):
+    # SQL written against the old columns may no longer be valid
+    invalidate_plans(changed)
+    invalidate_tables(changed)
+
+    print(f"Schema changed for {', '.join(changed)} - refreshed")
+
+
+def refresh_schema():
+    global _SCHEMA_INFO, _SCHEMA_FINGERPRINTS, _SCHEMA_CHECKED_AT
+
+    with _schema_lock:
+        fingerprints = schema_fingerprints()
+        changed = _changed_tables(fingerprints)
+
+        _SCHEMA_INFO = introspect_schema()
+        _render_schema(build_index(_SCHEMA_INFO))
+        _SCHEMA_FINGERPRINTS = fingerprints
+        _SCHEMA_CHECKED_AT = time.time()
+
+    if changed:
+        _invalidate_changed(changed)
+
+    print("Database schema loaded and cached in memory")
+
+
+def check_schema(force: bool = False) -> list:
+    """
+    Compare table fingerprints (at most every SCHEMA_CHECK_INTERVAL
+    seconds) and rebuild only the changed tables. Plans and cached
+    results reading those tables are invalidated. Returns changed tables.
+
+    Also runs before cache hits are served and after loads, when the
+    schema text itself may never have been loaded in this process.
+    """
+    global _SCHEMA_INFO, _SCHEMA_FINGERPRINTS, _SCHEMA_CHECKED_AT
+
+    with _schema_lock:
+        if not force and time.time() - _SCHEMA_CHECKED_AT < SCHEMA_CHECK_INTERVAL:
+            return []
+
+        fingerprints = schema_fingerprints()
+        _SCHEMA_CHECKED_AT = time.time()
+
+        changed = _changed_tables(fingerprints)
+
+        if not changed:
+            _SCHEMA_FINGERPRINTS = fingerprints
+            return []
+
+        # Not loaded yet: the first get_schema_cached() reads it whole
+        if _SCHEMA_INFO is not None:
+            present = [t for t in changed if t in fingerprints]
+            partial = introspect_schema(tables=present) if present else None
+
+            # Copy so readers holding the old schema never see it change
+            tables = {t: v for t, v in _SCHEMA_INFO.tables.items() if t not in changed}
+
+            if partial is not None:
+                tables.update(partial.tables)
+
+            _SCHEMA_INFO = DatabaseSchema(tables)
+
+            _render_schema(build_index(_SCHEMA_INFO, previous=_SCHEMA_INDEX, changed=changed))
+
+        _SCHEMA_FINGERPRINTS = fingerprints
+
+    _invalidate_changed(changed)
+    return changed
+
+
+async def check_schema_async():
+    """
+    check_schema() for the request path: a thread hop only when the
+    interval has passed, and a failed check never fails the request.
+    """
+    if time.time() - _SCHEMA_CHECKED_AT < SCHEMA_CHECK_INTERVAL:
+        return
+
+    try:
+        await asyncio.to_thread(check_schema)
+    except Exception as e:
+        print(f"Schema check failed: {e}")
 
 
 def get_schema_cached():
-    global _SCHEMA
     if _SCHEMA is None:
-        _SCHEMA = get_schema_text()
+        refresh_schema()
+    else:
+        check_schema()
     return _SCHEMA
 
 
-def refresh_schema():
-    global _SCHEMA
-    _SCHEMA = get_schema_text()
+def get_prompt_schema(question: str):
+    """
+    Schema text for this question: only the relevant tables (plus FK
+    neighbours) when retrieval is confident, else the full schema.
+    Returns (schema_text, stats) where stats go into the usage dict.
+    """
+    full = get_schema_cached()
+
+    with _schema_lock:
+        info, index, full_tokens = _SCHEMA_INFO, _SCHEMA_INDEX, _SCHEMA_TOKENS
 
+    tables = index.select_tables(question)
 
-print("Database schema loaded and cached in memory")
+    if tables:
+        schema = "\n\n".join(render_table_text(info.tables[t]) for t in tables)
+    else:
+        schema = full
+
+    used_tokens = estimate_tokens(schema) if tables else full_tokens
+
+    return schema, {
+        "schema_tables": tables or info.table_names(),
+        "schema_pruned": bool(tables),
+        "schema_tokens_full": full_tokens,
+        "schema_tokens_used": used_tokens,
+        "schema_tokens_saved": full_tokens - used_tokens
+    }
 
 
 prompt = ChatPromptTemplate.from_template(
@@ -102,7 +267,62 @@ QUESTION:
 """
 )
 
-chain = prompt | llm
+# The model client and chain are built on first use, not at import
+_llm = None
+_chain = None
+_llm_lock = threading.RLock()
+
+
+def get_llm():
+    global _llm
+
+    if _llm is None:
+        with _llm_lock:
+            if _llm is None:
+                from langchain_openai import ChatOpenAI
+
+                _llm = ChatOpenAI(
+                    model="gpt-4.1-mini",
+                    temperature=0,
+                    api_key=get_openai_api_key()
+                )
+
+    return _llm
+
+
+def get_chain():
+    global _chain
+
+    if _chain is None:
+        with _llm_lock:
+            if _chain is None:
+                # Disk-cached / record / replay access to the model (LLM_MODE);
+                # only completions that pass validation are recorded
+                provider = build_provider(get_llm(), accept=_is_valid_completion)
+                _chain = prompt | provider.as_runnable()
+
+    return _chain
+
+
+def __getattr__(name):
+    # `llm` / `chain` attributes still work, lazily
+    if name == "llm":
+        return get_llm()
+    if name == "chain":
+        return get_chain()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def set_llm(model):
+    """
+    Swap the chat model, e.g. for a deterministic fake in offline
+    benchmarks. The swapped-in model bypasses the response cache.
+    """
+    global _llm, _chain
+
+    with _llm_lock:
+        _llm = model
+        _chain = prompt | model
 
 
 def clean_sql(output: str) -> str:
@@ -126,6 +346,10 @@ def clean_sql(output: str) -> str:
 FORBIDDEN = ["DROP", "DELETE", "UPDATE", "INSERT", "ALTER", "TRUNCATE"]
 
 
+def _is_valid_completion(content: str) -> bool:
+    return validate_sql(clean_sql(content))
+
+
 def validate_sql(sql: str) -> bool:
 
     upper = sql.upper().strip()
@@ -139,9 +363,7 @@ def validate_sql(sql: str) -> bool:
     return True
 
 
-def generate_sql(question: str):
-
-    schema = get_schema_cached()
+def _start_generation(question: str, schema: str):
 
     # Start ROOT TRACE (not span)
     trace = langfuse.start_trace(
@@ -159,65 +381,213 @@ def generate_sql(question: str):
         }
     )
 
+    return trace, generation
+
+
+def _parse_response(raw_output: str, cb):
+
+    # Token usage metrics; recorded before validation, since a
+    # rejected completion was still paid for
+    usage = {
+        "prompt_tokens": cb.prompt_tokens,
+        "completion_tokens": cb.completion_tokens,
+        "total_tokens": cb.total_tokens,
+        "cost_usd": cb.total_cost
+    }
+    record_usage(usage)
+
+    sql = clean_sql(raw_output)
+
+    if not validate_sql(sql):
+        raise ValueError(f"Unsafe SQL generated:\n{raw_output}")
+
+    return sql, usage
+
+
+def _record_success(trace, generation, sql: str, usage: dict):
+
+    generation.update(
+        output={"sql": sql},
+        metadata=usage
+    )
+    generation.end()
+
+    trace.update(
+        output={"sql": sql},
+        metadata={"success": True}
+    )
+
+
+def _record_error(trace, generation, e: Exception):
+
+    generation.update(
+        output={"error": str(e)},
+        level="ERROR",
+        status_message=str(e)
+    )
+    generation.end()
+    trace.update(
+        output={"error": str(e)},
+        level="ERROR",
+        status_message=str(e)
+    )
+
+
+def generate_sql(question: str):
+
+    with timed("schema_fetch"):
+        schema, schema_stats = get_prompt_schema(question)
+
+    trace, generation = _start_generation(question, schema)
+
     try:
 
         # Capture token usage
         with get_openai_callback() as cb:
 
-            response = chain.invoke({
-                "schema": schema,
-                "question": question
-            })
+            with timed("llm_generation"):
+                response = get_chain().invoke({
+                    "schema": schema,
+                    "question": question
+                })
 
-            raw_output = response.content
-            sql = clean_sql(raw_output)
+            sql, usage = _parse_response(response.content, cb)
 
-            if not validate_sql(sql):
-                raise ValueError(f"Unsafe SQL generated:\n{raw_output}")
+        usage.update(schema_stats)
+        _record_success(trace, generation, sql, usage)
 
-            # Token usage metrics
-            usage = {
-                "prompt_tokens": cb.prompt_tokens,
-                "completion_tokens": cb.completion_tokens,
-                "total_tokens": cb.total_tokens,
-                "cost_usd": cb.total_cost
-            }
+        return sql, usage
 
-        # Log success
-        generation.update(
-            output={"sql": sql},
-            metadata=usage
-        )
-        generation.end()
+    except Exception as e:
 
-        trace.update(
-            output={"sql": sql},
-            metadata={"success": True}
-        )
+        # Log error to Langfuse
+        _record_error(trace, generation, e)
+
+        raise
+
+    finally:
+        # Exported in the background by the tracing facade
+        trace.end()
+
+
+async def generate_sql_async(question: str):
+
+    # Introspection only runs on the first call; keep it off the event loop
+    with timed("schema_fetch"):
+        schema, schema_stats = await asyncio.to_thread(get_prompt_schema, question)
+
+    trace, generation = _start_generation(question, schema)
+
+    try:
+
+        with get_openai_callback() as cb:
+
+            with timed("llm_generation"):
+                response = await get_chain().ainvoke({
+                    "schema": schema,
+                    "question": question
+                })
+
+            sql, usage = _parse_response(response.content, cb)
+
+        usage.update(schema_stats)
+        _record_success(trace, generation, sql, usage)
 
         return sql, usage
 
     except Exception as e:
 
-        # Log error to Langfuse
+        _record_error(trace, generation, e)
+
+        raise
+
+    finally:
+        trace.end()
+
+
+async def generate_sql_batch_async(questions: list, concurrency: int = 4):
+    """
+    One chain.abatch call for many questions, at most `concurrency`
+    LLM requests in flight. Returns one (sql, usage) tuple or
+    Exception per question, in input order.
+    """
+
+    if not questions:
+        return []
+
+    with timed("schema_fetch"):
+        prompt_schemas = await asyncio.to_thread(
+            lambda: [get_prompt_schema(q) for q in questions]
+        )
+
+    trace = langfuse.start_trace(
+        name="text-to-sql-batch",
+        input={"questions": questions}
+    )
+
+    generation = trace.start_generation(
+        name="sql-generation-batch",
+        model="gpt-4.1-mini",
+        input={"questions": questions}
+    )
+
+    # One handler per input so token usage stays per question
+    handlers = [_callback_handler() for _ in questions]
+
+    try:
+        # One observation for the whole batch
+        with timed("llm_generation"):
+            responses = await get_chain().abatch(
+                [
+                    {"schema": schema, "question": q}
+                    for q, (schema, _) in zip(questions, prompt_schemas)
+                ],
+                config=[
+                    {"callbacks": [h], "max_concurrency": concurrency}
+                    for h in handlers
+                ],
+                return_exceptions=True
+            )
+
+        results = []
+
+        for response, cb, (_, schema_stats) in zip(responses, handlers, prompt_schemas):
+            if isinstance(response, Exception):
+                results.append(response)
+                continue
+
+            try:
+                sql, usage = _parse_response(response.content, cb)
+            except ValueError as e:
+                results.append(e)
+                continue
+
+            usage.update(schema_stats)
+            results.append((sql, usage))
+
+        failed = sum(isinstance(r, Exception) for r in results)
+
         generation.update(
-            output={"error": str(e)},
-            level="ERROR",
-            status_message=str(e)
+            output={"generated": len(results) - failed, "failed": failed},
+            metadata={
+                "total_tokens": sum(h.total_tokens for h in handlers),
+                "cost_usd": sum(h.total_cost for h in handlers),
+                "schema_tokens_saved": sum(st["schema_tokens_saved"] for _, st in prompt_schemas)
+            }
         )
         generation.end()
-        trace.update(
-            output={"error": str(e)},
-            level="ERROR",
-            status_message=str(e)
-        )
+        trace.update(metadata={"success": failed == 0})
+
+        return results
+
+    except Exception as e:
+
+        _record_error(trace, generation, e)
 
         raise
 
     finally:
         trace.end()
-        # Ensure logs are sent immediately
-        langfuse.flush()
 
 
 if __name__ == "__main__":
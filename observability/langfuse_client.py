@@ -1,5 +1,12 @@
+import atexit
+import itertools
 import os
-import streamlit as st
+import queue
+import random
+import sys
+import threading
+import time
+from collections import OrderedDict
 
 # Define mock classes first
 class MockSpan:
@@ -26,30 +33,283 @@ class Langfuse:
     def flush(self):
         pass
 
-# Try to import real Langfuse, fall back to mock if it fails
-try:
-    from langfuse import Langfuse as RealLangfuse
-    Langfuse = RealLangfuse
-except Exception:
-    # Use mock Langfuse if import fails (pydantic compatibility issue)
-    pass
+MockLangfuse = Langfuse
 
 def get_secret(key: str):
-    # Works locally + Streamlit Cloud
+    # Works locally + Streamlit Cloud. st.secrets is only read when the
+    # app already loaded streamlit; CLIs and workers never import it
+    st = sys.modules.get("streamlit")
     try:
-        if key in st.secrets:
+        if st is not None and key in st.secrets:
             return st.secrets[key]
     except Exception:
         pass
     return os.getenv(key)
 
 
-try:
-    langfuse = Langfuse(
-        public_key=get_secret("LANGFUSE_PUBLIC_KEY"),
-        secret_key=get_secret("LANGFUSE_SECRET_KEY"),
-        host=get_secret("LANGFUSE_HOST")
-    )
-except Exception:
-    # Fall back to mock if initialization fails
-    langfuse = Langfuse()
+def make_client():
+    """
+    The real Langfuse client, or the mock when it can't be imported
+    (pydantic compatibility issue) or initialized. Called by the exporter
+    thread on the first export, so importing this module stays cheap.
+    """
+    try:
+        from langfuse import Langfuse as RealLangfuse
+
+        return RealLangfuse(
+            public_key=get_secret("LANGFUSE_PUBLIC_KEY"),
+            secret_key=get_secret("LANGFUSE_SECRET_KEY"),
+            host=get_secret("LANGFUSE_HOST")
+        )
+    except Exception:
+        return MockLangfuse()
+
+
+# Pending events; when full, events are dropped rather than blocking callers
+TRACE_QUEUE_SIZE = int(os.getenv("TRACE_QUEUE_SIZE", 10_000))
+TRACE_BATCH_SIZE = int(os.getenv("TRACE_BATCH_SIZE", 500))
+TRACE_FLUSH_INTERVAL = float(os.getenv("TRACE_FLUSH_INTERVAL", 2.0))
+
+# Fraction of traces recorded at all
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", 1.0))
+
+# Above this queue fill ratio new traces are not started
+TRACE_HIGH_WATER = float(os.getenv("TRACE_HIGH_WATER", 0.8))
+
+TRACE_SHUTDOWN_TIMEOUT = float(os.getenv("TRACE_SHUTDOWN_TIMEOUT", 5.0))
+
+# Open spans whose `end` never arrives (dropped, or never sent) are
+# forgotten after this many seconds, or oldest-first past TRACE_MAX_OPEN
+TRACE_SPAN_TTL = float(os.getenv("TRACE_SPAN_TTL", 600))
+TRACE_MAX_OPEN = int(os.getenv("TRACE_MAX_OPEN", 10_000))
+
+
+_NOOP = MockTrace()
+
+
+class _Span:
+    """
+    Handle returned to callers. Every call only enqueues an event;
+    the exporter thread replays it against the real client.
+    """
+
+    __slots__ = ("_tracer", "_id")
+
+    def __init__(self, tracer, span_id: int):
+        self._tracer = tracer
+        self._id = span_id
+
+    def start_span(self, *args, **kwargs):
+        return self._tracer._child("span", self._id, args, kwargs)
+
+    def start_generation(self, *args, **kwargs):
+        return self._tracer._child("generation", self._id, args, kwargs)
+
+    def update(self, *args, **kwargs):
+        self._tracer._put(("update", self._id, None, args, kwargs))
+        return self
+
+    def end(self):
+        self._tracer._put(("end", self._id, None, (), {}))
+
+
+class Tracer:
+    """
+    Non-blocking facade over a Langfuse client: span/trace calls go into a
+    bounded queue and a daemon thread exports them in batches. Under
+    backpressure new traces are skipped and excess events dropped.
+    """
+
+    def __init__(self, client=None, maxsize: int = TRACE_QUEUE_SIZE):
+        self._client = client  # None until the first export: make_client()
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._high_water = int(maxsize * TRACE_HIGH_WATER)
+        self._ids = itertools.count(1)
+        # event id -> (real client object, opened at); exporter thread only
+        self._objects = OrderedDict()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            "exported": 0,
+            "sampled_out": 0,
+            "dropped_traces": 0,
+            "dropped_events": 0,
+            "export_errors": 0,
+            "expired_spans": 0
+        }
+
+    def set_client(self, client):
+        """Swap the export sink, e.g. MockLangfuse() in tests."""
+        self.flush()
+        self._client = client
+
+    def start_trace(self, *args, **kwargs):
+        if TRACE_SAMPLE_RATE < 1.0 and random.random() >= TRACE_SAMPLE_RATE:
+            self._count("sampled_out")
+            return _NOOP
+
+        if self._queue.qsize() >= self._high_water:
+            self._count("dropped_traces")
+            return _NOOP
+
+        return self._child("trace", None, args, kwargs)
+
+    def _child(self, kind: str, parent_id, args, kwargs):
+        span_id = next(self._ids)
+        self._put((kind, span_id, parent_id, args, kwargs))
+        return _Span(self, span_id)
+
+    def _put(self, event):
+        if self._thread is None:
+            self._start()
+
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            self._count("dropped_events")
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run,
+                    name="trace-exporter",
+                    daemon=True
+                )
+                self._thread.start()
+
+    def _run(self):
+        last_flush = time.time()
+
+        while True:
+            try:
+                batch = [self._queue.get(timeout=TRACE_FLUSH_INTERVAL)]
+            except queue.Empty:
+                batch = []
+
+            while batch and len(batch) < TRACE_BATCH_SIZE:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            for event in batch:
+                self._export(event)
+
+            self._expire()
+
+            if batch and (self._queue.empty() or time.time() - last_flush >= TRACE_FLUSH_INTERVAL):
+                self._flush_client()
+                last_flush = time.time()
+
+            for _ in batch:
+                self._queue.task_done()
+
+    def _export(self, event):
+        kind, span_id, parent_id, args, kwargs = event
+
+        try:
+            if kind == "trace":
+                self._open(span_id, self.client.start_trace(*args, **kwargs))
+
+            elif kind in ("span", "generation"):
+                parent = self._objects.get(parent_id)
+                if parent is not None:
+                    parent = parent[0]
+                    start = parent.start_span if kind == "span" else parent.start_generation
+                    self._open(span_id, start(*args, **kwargs))
+
+            elif kind == "update":
+                entry = self._objects.get(span_id)
+                if entry is not None:
+                    entry[0].update(*args, **kwargs)
+
+            elif kind == "end":
+                entry = self._objects.pop(span_id, None)
+                if entry is not None:
+                    entry[0].end()
+
+            self._count("exported")
+
+        except Exception:
+            self._count("export_errors")
+
+    @property
+    def client(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = make_client()
+        return self._client
+
+    def _open(self, span_id: int, obj):
+        self._objects[span_id] = (obj, time.time())
+
+        while len(self._objects) > TRACE_MAX_OPEN:
+            self._objects.popitem(last=False)
+            self._count("expired_spans")
+
+    def _expire(self):
+        # Insertion order is opening order, so expired entries lead
+        cutoff = time.time() - TRACE_SPAN_TTL
+
+        while self._objects:
+            span_id, (_, opened) = next(iter(self._objects.items()))
+            if opened >= cutoff:
+                break
+            del self._objects[span_id]
+            self._count("expired_spans")
+
+    def _count(self, name: str):
+        with self._stats_lock:
+            self._stats[name] += 1
+
+    def _flush_client(self):
+        if self._client is None:
+            return
+
+        try:
+            self._client.flush()
+        except Exception:
+            self._count("export_errors")
+
+    def flush(self, timeout: float = TRACE_SHUTDOWN_TIMEOUT) -> bool:
+        """
+        Block until queued events are exported (or timeout). Not for the
+        request path; used on shutdown and in tests.
+        """
+        if self._thread is None:
+            return True
+
+        deadline = time.time() + timeout
+
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._queue.all_tasks_done.wait(remaining)
+
+        self._flush_client()
+        return True
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            stats = dict(self._stats)
+        return {**stats, "queued": self._queue.qsize(), "open_spans": len(self._objects)}
+
+
+tracer = Tracer()
+
+# Existing imports use `langfuse`; it is the non-blocking facade now
+langfuse = tracer
+
+atexit.register(tracer.flush)
+
+
+def __getattr__(name):
+    # `client` is created on first use
+    if name == "client":
+        return tracer.client
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")